@@ -0,0 +1,195 @@
+"""Synthetic benchmarks of snake on large build graphs.
+
+Generates projects in a temporary directory and times a full build, a no-op
+build and an incremental build after touching a single source. Each build
+runs in a fresh interpreter, so graph construction and scanning start cold;
+both the time spent in snake and the wall time including interpreter start
+up are recorded, along with peak memory. Results are written as JSON, which
+--baseline compares against the results of an earlier run, e.g. of another
+commit.
+
+    python bench.py -o new.json
+    python bench.py --scale 0.1 --baseline old.json
+
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from snake import Dir, Target, Tool, Session
+
+PHASES = ('full', 'noop', 'incremental')
+
+
+def wide(root, size, generate):
+    """One Dir of size files, each mapped to an output copied from it."""
+    src = os.path.join(root, 'src')
+    if generate:
+        os.makedirs(src)
+        os.makedirs(os.path.join(root, 'out'))
+        for i in range(size):
+            with open(os.path.join(src, 'f{}.c'.format(i)), 'w') as source:
+                source.write('x\n')
+    files = Dir(src, tool=Tool('cp {inp} {out}'))
+    files.map(os.path.join(src, '*.c'), os.path.join(root, 'out', '*.o'))
+    return [files], os.path.join(src, 'f0.c')
+
+
+def deep(root, size, generate):
+    """A chain of size Targets, each one copied from the one before."""
+    seed = os.path.join(root, 'seed')
+    if generate:
+        os.makedirs(os.path.join(root, 'out'))
+        with open(seed, 'w') as source:
+            source.write('x\n')
+    copy = Tool('cp {inp} {out}')
+    target = seed
+    for i in range(size):
+        target = Target(os.path.join(root, 'out', 't{}'.format(i)), deps=[target], tool=copy)
+    return [target], seed
+
+
+def diamond(root, size, generate, width=10):
+    """Layers of width Targets, each depending on two of the layer below, so
+    that every node is shared by two dependents.
+    """
+    if generate:
+        os.makedirs(os.path.join(root, 'out'))
+        for i in range(width):
+            with open(os.path.join(root, 's{}'.format(i)), 'w') as source:
+                source.write('x\n')
+    # sort -u of identical one line files stays one line however deep it goes
+    merge = Tool('sort -u -o {out} {inp}')
+    layer = [os.path.join(root, 's{}'.format(i)) for i in range(width)]
+    for depth in range(max(size // width, 1)):
+        layer = [Target(os.path.join(root, 'out', 'n{}_{}'.format(depth, i)),
+                        deps=[layer[i], layer[(i + 1) % width]], tool=merge)
+                 for i in range(width)]
+    top = Target(os.path.join(root, 'out', 'top'), deps=layer, tool=merge)
+    return [top], os.path.join(root, 's0')
+
+
+def maps(root, size, generate, rules=12):
+    """A recursive Dir of size files spread over rules extensions, each with
+    its own map() rule.
+    """
+    src = os.path.join(root, 'src')
+    if generate:
+        for sub in range(rules):
+            os.makedirs(os.path.join(src, 'd{}'.format(sub)))
+            os.makedirs(os.path.join(root, 'out', 'd{}'.format(sub)))
+        for i in range(size):
+            path = os.path.join(src, 'd{}'.format(i % rules), 'f{}.e{}'.format(i, i % rules))
+            with open(path, 'w') as source:
+                source.write('x\n')
+    files = Dir(src, recursive=True, tool=Tool('cp {inp} {out}'))
+    for rule in range(rules):
+        files.map(os.path.join(src, '*.e{}'.format(rule)), os.path.join(root, 'out', '*.o{}'.format(rule)))
+    return [files], os.path.join(src, 'd0', 'f0.e0')
+
+
+SCENARIOS = {
+    'wide': (wide, 10000),
+    'deep': (deep, 1000),
+    'diamond': (diamond, 1000),
+    'maps': (maps, 10000),
+}
+
+
+def run_phase(scenario, root, size, jobs):
+    """Build scenario once in this process and return its measurements."""
+    start = time.perf_counter()
+    nodes, _ = SCENARIOS[scenario][0](root, size, False)
+    Session(jobs=jobs, log=os.path.join(root, '.snake_log')).build(*nodes)
+    return {
+        'seconds': time.perf_counter() - start,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench(scenario, size, jobs):
+    """Generate scenario and measure each phase in a child interpreter."""
+    root = tempfile.mkdtemp(prefix='snake-bench-')
+    try:
+        _, touched = SCENARIOS[scenario][0](root, size, True)
+        result = {'scenario': scenario, 'size': size, 'jobs': jobs}
+        for phase in PHASES:
+            if phase == 'incremental':
+                stat = os.stat(touched)
+                os.utime(touched, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            start = time.perf_counter()
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--phase',
+                                              scenario, root, str(size), '--jobs', str(jobs)])
+            result[phase + '_wall'] = time.perf_counter() - start
+            measured = json.loads(output.decode().splitlines()[-1])
+            result[phase] = measured['seconds']
+            result[phase + '_peak_rss_kb'] = measured['peak_rss_kb']
+        return result
+    finally:
+        shutil.rmtree(root)
+
+
+def compare(results, baseline):
+    """Print how every phase's time changed relative to baseline."""
+    old = {(res['scenario'], res['size']): res for res in baseline['results']}
+    for res in results['results']:
+        base = old.get((res['scenario'], res['size']))
+        if base is None:
+            continue
+        for phase in PHASES:
+            print('{:>8} {:>7} {:>12}: {:8.3f}s -> {:8.3f}s  ({:+.0%})'.format(
+                res['scenario'], res['size'], phase, base[phase], res[phase],
+                res[phase] / base[phase] - 1 if base[phase] else 0))
+
+
+def revision():
+    """Returns the git commit of this checkout, if there is one."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='one of {} (default: all)'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every scenario size')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('-o', '--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results in this file')
+    parser.add_argument('--phase', nargs=3, metavar=('SCENARIO', 'ROOT', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(scenario))
+
+    if args.phase:
+        scenario, root, size = args.phase
+        print(json.dumps(run_phase(scenario, root, int(size), args.jobs)))
+        return
+
+    results = {'revision': revision(), 'python': sys.version.split()[0], 'results': []}
+    for scenario in args.scenarios or sorted(SCENARIOS):
+        size = max(int(SCENARIOS[scenario][1] * args.scale), 1)
+        results['results'].append(bench(scenario, size, args.jobs))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,22 @@
+from snake import Target, Dir, Tool, target
 
-from snake import Target, Dir, Tool
-import sys
+# Build with: python -m snake [main|test]
 
-# Main GCC
-gcc = Tool("gcc {inp} -o {out}")
-# Object gcc
-obj_gcc = Tool("gcc -c {inp} -o {out}")
+# Main GCC and object gcc, optimized for main and only verbose for test
+main_gcc = Tool("gcc {inp} -o {out}", flags=["-v -O3"])
+main_obj_gcc = Tool("gcc -c {inp} -o {out}", flags=["-v -O3"])
+test_gcc = Tool("gcc {inp} -o {out}", flags=["-v"])
+test_obj_gcc = Tool("gcc -c {inp} -o {out}", flags=["-v"])
 
-# Util directory
-util = Dir('src/util', tool=obj_gcc)
+# Util directory, built into separate objects for each executable as their
+# flags differ
+util = Dir('src/util', tool=main_obj_gcc)
 util.map('src/util/*.c', 'obj/util/*.o')
+test_util = Dir('src/util', tool=test_obj_gcc)
+test_util.map('src/util/*.c', 'obj/test/util/*.o')
 
 # Main exectuable
-main_out = 'bin/main'
-main_prog = Target(main_out, deps=['src/main.c', util])
+main_prog = target('main', Target('bin/main', deps=['src/main.c', util], tool=main_gcc))
 
 # Test executable
-test_out = 'bin/test'
-test_prog = Target(test_out, deps=['src/test.c', util])
-
-# Command line options
-if len(sys.argv) == 1 or sys.argv[1] == 'main':
-    gcc.flags("-v -O3")
-    obj_gcc.flags("-v -O3")
-    main_prog.build(gcc)
-elif sys.argv[1] == 'test':
-    gcc.flags("-v")
-    obj_gcc.flags("-v")
-    test_prog.build(gcc)
-else:
-    print("No such target '{}'".format(sys.argv[1]))
+test_prog = target('test', Target('bin/test', deps=['src/test.c', test_util], tool=test_gcc))
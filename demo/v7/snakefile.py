@@ -4,7 +4,8 @@ warns = ['-W', '-Wall', '-pedantic', '-Wno-comment', '-Wno-variadic-macros', '-W
 v7_flags = ['-DCS_ENABLE_UTF8']
 cflags = warns + ['-g', '-O3', '-lm'] + v7_flags
 
-cc = Tool('gcc {inp} -o {out}', flags=['-DV7_EXE'] + cflags)
+# gcc reports the headers v7.c includes in v7.d, so editing one rebuilds v7
+cc = Tool('gcc {inp} -o {out} -MMD -MF {out}.d', flags=['-DV7_EXE'] + cflags, depfile='{out}.d')
 
 v7 = Target('v7', tool=cc, deps=['v7.c'])
 v7.build()
@@ -5,39 +5,159 @@
     Jinxing Wang
 
 """
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
 import os
+import pickle
+import queue
 import re
+import resource
+import select
+import shutil
+import socket
+import socketserver
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from contextlib import contextmanager, nullcontext
 import __main__
 
-ABS_DIR_PATH = os.path.realpath(os.path.dirname(__main__.__file__))
+# the directory of the snakefile, or the working directory without one
+ABS_DIR_PATH = os.path.realpath(os.path.dirname(getattr(__main__, '__file__', '')))
+LOG_NAME = '.snake_log'
+HASH_NAME = '.snake_hashes'
+GRAPH_NAME = '.snake_graph'
+# the format of the graph pickled into GRAPH_NAME, to be raised whenever the
+# slots of _Job or Tool, or the pickled tuple, change
+GRAPH_VERSION = 2
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'snake')
+# directories a recursive Dir lists at once; listing waits on the disk more
+# than on the CPU
+WALK_THREADS = 8
 
 
-def flatten(lst):
-    res = []
-    for item in lst:
-        if isinstance(item, str):
-            res.append(item)
-        if isinstance(item, list):
-            res += item
+def any_newer(dep, me, stats=None):
+    mtime = os.path.getmtime if stats is None else stats.mtime_ns
+    my_mtime = mtime(me)
+    if isinstance(dep, list):
+        return any(mtime(path) > my_mtime for path in dep)
+    return mtime(dep) > my_mtime
 
-    return res
 
+class StatCache:
+    """Stats every path at most once per build session, keeping only its
+    mtime. Files found while scanning a Dir are remembered too, which answers
+    existence checks for them without any stat at all. saved counts the
+    stats avoided.
+    """
+    _FOUND = object()
 
-def all_exist(dep):
-    if isinstance(dep, list):
-        return all(os.path.exists(path) for path in dep)
-    return os.path.exists(dep)
+    def __init__(self):
+        self._stats = {}
+        self.saved = 0
 
+    def add(self, path):
+        """Remember that path was found by scanning its directory."""
+        self._stats.setdefault(path, self._FOUND)
 
-def any_newer(dep, me):
-    if isinstance(dep, list):
-        return any(os.path.getmtime(path) > os.path.getmtime(me) for path in dep)
-    return os.path.getmtime(dep) > os.path.getmtime(me)
+    def _stat(self, path):
+        """Returns the mtime_ns of path, or None if it does not exist."""
+        res = self._stats.get(path, self._FOUND)
+        if res is not self._FOUND:
+            self.saved += 1
+            return res
+        try:
+            res = os.stat(path).st_mtime_ns
+        except OSError:
+            res = None
+        self._stats[path] = res
+        return res
+
+    def exists(self, path):
+        """Whether path exists."""
+        if self._stats.get(path) is self._FOUND:
+            self.saved += 1
+            return True
+        return self._stat(path) is not None
+
+    def mtime_ns(self, path):
+        """Returns the modification time of path in nanoseconds."""
+        res = self._stat(path)
+        if res is None:
+            raise FileNotFoundError(path)
+        return res
+
+    def invalidate(self, path):
+        """Forget path, e.g. after a command rewrote it."""
+        self._stats.pop(path, None)
+
+
+# directory path -> (mtime_ns, files, subdirs) of its last listing
+_LISTINGS = {}
+
+
+def _list_dir(path):
+    """Returns the paths of the visible files and of the subdirectories in
+    path. Listings are kept for as long as the directory's mtime, which
+    changes whenever an entry is added, removed or renamed, stays the same.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    listing = _LISTINGS.get(path)
+    if listing is not None and listing[0] == mtime:
+        return listing[1], listing[2]
+
+    files = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # like os.walk, do not follow symlinks to directories
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif entry.name[0] != '.':
+                files.append(entry.path)
+    # an entry added within the same mtime tick as this listing would go
+    # unnoticed, so only keep listings of directories not changed just now
+    if mtime < time.time_ns() - 10 ** 9:
+        _LISTINGS[path] = (mtime, files, subdirs)
+    return files, subdirs
+
+
+def _ext(path):
+    """Returns the extension of path's final component, or ''."""
+    dot = path.rfind('.')
+    return path[dot:] if dot > path.rfind('/') else ''
+
+
+def _call(args, cwd=None, stdout=None, stderr=None):
+    """Run args like subprocess.check_call, but return the child's resource
+    usage as reported by os.wait4.
+    """
+    proc = subprocess.Popen(args, cwd=cwd, stdout=stdout, stderr=stderr)
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    return usage
 
 
 class Dir:
     """A helpful wrapper around a group of files in a common directory."""
+    __slots__ = ('recursive', 'path', 'maps', 'dependencies', '_tool', '_index')
+
     def __init__(self, dir_name, recursive=False, tool=None, deps=()):
         """Constructs a directory target from the specified dirname. Every
         file in the directory is then treated as a dependency. The optional
@@ -49,13 +169,14 @@ class Dir:
         # allow for full-paths to be used if they start with '/'
         self.recursive = recursive
         if dir_name[0] == "/":
-            self.path = dir_name
+            self.path = os.path.normpath(dir_name)
         else:
-            self.path = os.path.join(ABS_DIR_PATH, dir_name)
+            self.path = os.path.normpath(os.path.join(ABS_DIR_PATH, dir_name))
         if not os.path.isdir(self.path):
             raise Exception('specified directory does not exist')
 
         self.maps = []
+        self._index = {}
         self.dependencies = []
         self._tool = None
 
@@ -75,7 +196,38 @@ class Dir:
         """
         if "*" in out and "*" not in inp:
             raise Exception("In must have * if out has *")
-        self.maps.append({"in": inp.replace("*", "(.+)"), "out": out})
+        if inp.count("*") > 1:
+            raise Exception("In must have at most one *")
+        if inp[0] != "/":
+            inp = os.path.join(ABS_DIR_PATH, inp)
+        prefix, star, suffix = os.path.normpath(inp).partition("*")
+        if not star:
+            prefix, suffix = "", prefix
+        # a pattern matches whole paths only: the literal prefix and suffix
+        # around at least one character standing in for the *
+        self.maps.append({"prefix": prefix, "suffix": suffix, "star": bool(star),
+                          "ext": _ext(suffix) if "." in suffix else None, "out": out})
+        self._index = {}
+
+    def _map(self, path):
+        """Returns the output that the first matching mapping binds path to,
+        or None. Only the mappings whose suffix has path's extension, or no
+        extension at all, are tried.
+        """
+        ext = _ext(path)
+        candidates = self._index.get(ext)
+        if candidates is None:
+            candidates = [mapping for mapping in self.maps if mapping["ext"] in (ext, None)]
+            self._index[ext] = candidates
+        for mapping in candidates:
+            prefix, suffix = mapping["prefix"], mapping["suffix"]
+            if not mapping["star"]:
+                if path == suffix:
+                    return mapping["out"]
+            elif (len(path) > len(prefix) + len(suffix)
+                  and path.startswith(prefix) and path.endswith(suffix)):
+                return mapping["out"].replace("*", path[len(prefix):len(path) - len(suffix)])
+        return None
 
     def depends_on(self, *deps):
         """Specifies the dependencies of this directory, i.e. its input in the
@@ -104,71 +256,158 @@ class Dir:
         """
         return self._tool is not None
 
-    def build(self, tool=None):
+    def build(self, tool=None, **options):
         """Build this directory with the specified tool. If no tool is specified
         here, a tool must have been previously specified by a call to tool().
         Only dependencies which are bound to an output will be built.
         :param tool: program with which to build the files in this directory
+        :param options: passed on to Session, e.g. jobs
+        """
+        if tool:
+            self._tool = tool
+        return Session(**options).build(self)[0]
+
+    def plan(self, tool=None, **options):
+        """Returns the commands build() would run, without running any, as
+        (output, command, reason) tuples. See Session.plan().
+        :param tool: program with which to build the files in this directory
+        :param options: passed on to Session
+        """
+        if tool:
+            self._tool = tool
+        return Session(**options).plan(self)
+
+    def watch(self, tool=None, interval=0.5, poll=False, rebuilds=None, **options):
+        """Build this directory, then rebuild it whenever its sources change.
+        See Session.watch().
+        :param tool: program with which to build the files in this directory
+        :param options: passed on to Session, e.g. jobs
         """
         if tool:
             self._tool = tool
-        # contents = scan dir
-        contents = self._get_files()
-        # contents[i] = Target if contents[i] matches a mapping
-        for mapping in self.maps:
-            for i in range(len(contents)):
-                matches = re.search(mapping["in"], contents[i])
-                if matches:
-                    contents[i] = Target(mapping['out'].replace("*", matches.group(1)), deps=[contents[i]])
-
-        for i in range(len(contents)):
-            # everything that is not a Target becomes a Leaf
-            if not isinstance(contents[i], Target):
-                contents[i] = Leaf(contents[i])
-            # everything that is a Target gets dependencies
+        Session(**options).watch(self, interval=interval, poll=poll, rebuilds=rebuilds)
+
+    def _contents(self, stats=None):
+        """Returns the files in this Dir, with every file matched by a mapping
+        replaced by a Target building it and every other file wrapped in a
+        Leaf.
+        """
+        contents = []
+        for path in self._get_files(stats):
+            out = self._map(path)
+            if out is None:
+                contents.append(Leaf(path))
             else:
-                for dep in self.dependencies:
-                    contents[i].depends_on(dep)
+                contents.append(Target(out, deps=[path] + self.dependencies))
+        return contents
 
-        return [res.build() if res.has_tool() else res.build(self._tool) for res in contents]
+    def _get_files(self, stats=None):
+        """Returns list of files in this Dir. The files found are handed to
+        the optional StatCache stats.
+        """
+        listings = {dirname: (files, subdirs) for dirname, files, subdirs in self._walk()}
+        contents = self._ordered(listings)
+        if stats is not None:
+            for path in contents:
+                stats.add(path)
+        return contents
 
-    def _get_files(self):
-        """Returns list of files in this Dir."""
+    def _ordered(self, listings):
+        """Returns the files of the directory listings _walk() yielded, as
+        a dict of dirname -> (files, subdirs), in a stable order: every
+        directory's own files before those of its subdirectories. What
+        stands in for the files, e.g. what they resolve to, may be listed in
+        place of them.
+        """
         contents = []
-        if self.recursive:
-            for dirname, _, files in os.walk(self.path):
-                for filename in files:
-                    if filename[0] != '.':
-                        contents.append(os.path.join(dirname, filename))
-        else:
-            dirname, _, files = next(os.walk(self.path))
-            for filename in files:
-                if filename[0] != ".":
-                    contents.append(os.path.join(dirname, filename))
+        dirs = [self.path]
+        while dirs:
+            listing = listings.get(dirs.pop())
+            if listing is None:
+                # removed between listing its parent and listing it
+                continue
+            files, subdirs = listing
+            contents += files
+            dirs.extend(reversed(subdirs))
         return contents
 
-    @property
-    def _out(self):
-        # contents = scan dir
-        contents = self._get_files()
-        # contents[i] = Target if contents[i] matches a mapping
-        for mapping in self.maps:
-            for i in range(len(contents)):
-                matches = re.search(mapping["in"], contents[i])
-                if matches:
-                    contents[i] = Target(mapping['out'].replace("*", matches.group(1)), deps=[contents[i]])
+    def _walk(self, threads=WALK_THREADS):
+        """Yields (dirname, files, subdirs) for every directory scanned for
+        this Dir, as soon as it has been listed. The subdirectories of a
+        recursive Dir are listed on up to threads threads at once, so they
+        come in no particular order. Like os.walk, a subdirectory removed
+        before it could be listed is skipped; errors listing the Dir's own
+        directory are raised.
+        """
+        files, subdirs = _list_dir(self.path)
+        if not self.recursive:
+            yield self.path, files, []
+            return
+        yield self.path, files, subdirs
+        todo = queue.Queue()
+        listed = queue.Queue()
+
+        def work():
+            while True:
+                dirname = todo.get()
+                if dirname is None:
+                    return
+                try:
+                    listed.put((dirname, _list_dir(dirname), None))
+                except OSError as error:
+                    listed.put((dirname, None, error))
 
-        for i in range(len(contents)):
-            # everything that is not a Target becomes a Leaf
-            if not isinstance(contents[i], Target):
-                contents[i] = Leaf(contents[i])
+        workers = []
+        outstanding = 0
+        try:
+            while True:
+                for dirname in subdirs:
+                    todo.put(dirname)
+                    outstanding += 1
+                    if len(workers) < min(outstanding, threads):
+                        workers.append(threading.Thread(target=work, daemon=True))
+                        workers[-1].start()
+                if not outstanding:
+                    return
+                dirname, listing, error = listed.get()
+                outstanding -= 1
+                if isinstance(error, (FileNotFoundError, NotADirectoryError)):
+                    continue
+                if error is not None:
+                    raise error
+                files, subdirs = listing
+                yield dirname, files, subdirs
+        finally:
+            # when abandoned early, skip the directories not listed yet
+            while True:
+                try:
+                    todo.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in workers:
+                todo.put(None)
 
-        return [res._out for res in contents]
+    def _dirs(self):
+        """Returns the directories scanned for this Dir's files."""
+        dirs = [self.path]
+        if self.recursive:
+            for dirname in dirs:
+                try:
+                    dirs += _list_dir(dirname)[1]
+                except (FileNotFoundError, NotADirectoryError):
+                    if dirname == self.path:
+                        raise
+        return dirs
+
+    @property
+    def _out(self):
+        return [res._out for res in self._contents()]
 
 
 class Leaf:
     """Wrapper class for files"""
     # pylint: disable=missing-docstring,no-self-use
+    __slots__ = ('_out',)
 
     def __init__(self, filename):
         self._out = filename
@@ -182,6 +421,7 @@ class Leaf:
 
 class Target:
     """Root of dependency tree."""
+    __slots__ = ('_out', 'dependencies', '_tool')
 
     def __init__(self, out=None, deps=(), tool=None):
         """Constructs a new target object, with an output optionally specified.
@@ -232,67 +472,2271 @@ class Target:
         """
         return self._tool is not None
 
-    def build(self, tool=None):
+    def build(self, tool=None, **options):
         """Build this target with the specified tool. If no tool is specified
         here, a tool must have been specified previously by a call to tool().
         This target's output must have been previously set either in the
         constructor or in map().
         :param tool: program with which to build this Target
+        :param options: passed on to Session, e.g. jobs
         """
-        if self._out is None:
-            raise Exception('out was never specified')
         if tool is not None:
             self._tool = tool
-        if self._tool is None:
-            raise Exception('no tool specified for target')
-
-        run_command = False
-        if not os.path.exists(self._out):
-            run_command = True
-        if not run_command and not all(all_exist(dep._out) for dep in self.dependencies):
-            run_command = True
-
-        ins = [dep.build() if dep.has_tool() else dep.build(self._tool)
-               for dep in self.dependencies]
-
-        if not run_command and any(any_newer(dep, self._out) for dep in ins):
-            run_command = True
-        ins = flatten(ins)
-        command = self._tool.command()
-        in_string = " ".join(ins)
-        command = command.format(inp=in_string, out=self._out)
-        if run_command:
-            subprocess.check_call(command.split(" "))
+        return Session(**options).build(self)[0]
 
-        return self._out
+    def plan(self, tool=None, **options):
+        """Returns the commands build() would run, without running any, as
+        (output, command, reason) tuples. See Session.plan().
+        :param tool: program with which to build this Target
+        :param options: passed on to Session
+        """
+        if tool is not None:
+            self._tool = tool
+        return Session(**options).plan(self)
+
+    def watch(self, tool=None, interval=0.5, poll=False, rebuilds=None, **options):
+        """Build this target, then rebuild it whenever its sources change.
+        See Session.watch().
+        :param tool: program with which to build this Target
+        :param options: passed on to Session, e.g. jobs
+        """
+        if tool is not None:
+            self._tool = tool
+        Session(**options).watch(self, interval=interval, poll=poll, rebuilds=rebuilds)
 
 
 class Tool:
     """Represents a command-line tool command and its flags. Example, gcc."""
-    def __init__(self, command, flags=None):
+    __slots__ = ('_command', '_flags', '_depfile', '_batch', '_pool', '_pool_depth', '_template')
+
+    def __init__(self, command, flags=None, depfile=None, batch=None, pool=None, pool_depth=None):
         """The specified 'command' will be the actual program executed. The
         string must contain 2 mandatory placeholders {inp} and {out} and may
         contain a third optional placeholder {flags}. At build-time, these
         will be replaced with the Target's or Dir's input and output, as well as
         with this tool's flags. If the {flags} placeholder is omitted, any
         flags will be appended to the end.
+
+        The optional depfile names the Makefile-style dependency file the
+        command writes, e.g. '{out}.d' for gcc's -MMD -MF {out}.d. The files
+        listed in it become dependencies of the output on its next build.
+
+        With batch set to a number, the stale outputs of a Dir that share a
+        directory are built together, up to batch of them per command: {inp}
+        and {out} then expand to all of their inputs and outputs, and the
+        command runs in the outputs' directory. The {out} placeholder may be
+        left out for tools which name their outputs themselves (gcc -c).
+
+        The commands of all tools naming the same pool, e.g. 'link' for
+        memory hungry links, never run more than pool_depth at a time, however
+        many jobs the build runs in parallel.
         """
-        if "{inp}" not in command or "{out}" not in command:
+        if "{inp}" not in command or ("{out}" not in command and batch is None):
             raise Exception('command specified to Tool must have {inp} and {out}')
+        if batch is not None and batch < 1:
+            raise Exception('batch must be at least 1')
+        if (pool is None) != (pool_depth is None):
+            raise Exception('pool and pool_depth must be given together')
+        if pool_depth is not None and pool_depth < 1:
+            raise Exception('pool_depth must be at least 1')
 
         self._command = command.strip()
+        self._depfile = depfile
+        self._batch = batch
+        self._pool = pool
+        self._pool_depth = pool_depth
+        self._template = None
 
         if flags is None:
             self._flags = []
         else:
-            self._flags = flags
+            self._flags = list(flags)
 
     def flags(self, *fl):
         """Options specified when running this tool. One flag per argument."""
         self._flags.extend(fl)
+        self._template = None
 
     def command(self):
         """Return the current command string."""
-        if "{flags}" not in self._command:
-            self._command += " {flags}"
-        return self._command.format(flags=" ".join(self._flags), inp='{inp}', out='{out}').strip()
+        command = self._command if "{flags}" in self._command else self._command + " {flags}"
+        return command.format(flags=" ".join(self._flags), inp='{inp}', out='{out}').strip()
+
+    def argv(self, inp, out, response=None):
+        """Returns the argument list running this tool on the input paths inp
+        and the output paths out: every path is one argument, whatever
+        characters it holds. With response set, {inp} expands to @response
+        instead, for the tool to read the inputs from that response file.
+        """
+        if self._template is None:
+            # the command split once into literal arguments and placeholders
+            # standing for whole lists of arguments
+            tokens = self._command.split()
+            if "{flags}" not in self._command:
+                tokens.append("{flags}")
+            flags = " ".join(self._flags).split()
+            self._template = []
+            for token in tokens:
+                if token == "{flags}":
+                    self._template += flags
+                elif token in ("{inp}", "{out}"):
+                    self._template.append((token,))
+                elif "{" in token:
+                    self._template.append((token, " ".join(flags)))
+                else:
+                    self._template.append(token)
+        inp = ["@" + response] if response is not None else inp
+        argv = []
+        for token in self._template:
+            if isinstance(token, str):
+                argv.append(token)
+            elif len(token) == 1:
+                argv += inp if token[0] == "{inp}" else out
+            else:
+                argv.append(token[0].format(inp=" ".join(inp), out=" ".join(out), flags=token[1]))
+        return argv
+
+
+def parse_depfile(path):
+    """Returns the dependencies listed in the Makefile-style depfile at path,
+    as written by gcc -MD or clang -MD. Relative paths are made absolute.
+    """
+    with open(path) as depfile:
+        text = depfile.read().replace('\\\r\n', ' ').replace('\\\n', ' ')
+    deps = []
+    for line in text.splitlines():
+        tokens = []
+        token = ''
+        i = 0
+        while i < len(line):
+            char = line[i]
+            if char == '\\' and i + 1 < len(line) and line[i + 1] in ' #\\':
+                token += line[i + 1]
+                i += 1
+            elif char == '$' and line[i + 1:i + 2] == '$':
+                token += '$'
+                i += 1
+            elif char.isspace():
+                if token:
+                    tokens.append(token)
+                token = ''
+            else:
+                token += char
+            i += 1
+        if token:
+            tokens.append(token)
+        # everything up to the token ending in ':' names the rule's targets
+        for i, token in enumerate(tokens):
+            if token.endswith(':'):
+                deps += tokens[i + 1:]
+                break
+    return [dep if dep[0] == '/' else os.path.abspath(dep) for dep in deps]
+
+
+class BuildLog:
+    """On-disk record of how every output was last built: the expanded
+    command, the input list and the mtime stamps the inputs had at the time,
+    plus the implicit dependencies found in its depfile and their stamps.
+    With restat, the output's own stamp and content hash are kept as well.
+
+    Apart from those, the log keeps what the command building every output
+    cost the last HISTORY times it ran: a (time, costs) pair for each run,
+    where costs has a value for each of COSTS, i.e. the wall and CPU seconds
+    taken, the peak RSS in kB and the blocks read and written.
+    """
+    VERSION = 5
+    HISTORY = 10
+    COSTS = ('seconds', 'user', 'sys', 'maxrss', 'inblock', 'oublock')
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._history = {}
+        self._dirty = False
+        try:
+            with open(path, 'rb') as log:
+                data = pickle.load(log)
+            if data[0] == self.VERSION:
+                _, self._entries, self._history = data
+        except (OSError, EOFError, ValueError, IndexError, pickle.UnpicklingError):
+            pass
+
+    def get(self, out):
+        """Returns the (command, ins, stamps, implicit, implicit_stamps,
+        out_stamp, digest) recorded for out, or None.
+        """
+        return self._entries.get(out)
+
+    def record(self, out, command, ins, stamps, implicit=(), implicit_stamps=(), out_stamp=None, digest=None):
+        """Remember how out has just been brought up to date."""
+        # headers are shared by many outputs; interned, pickle stores each once
+        entry = (command, ins, stamps, tuple(sys.intern(dep) for dep in implicit), implicit_stamps,
+                 out_stamp, digest)
+        if self._entries.get(out) != entry:
+            self._entries[out] = entry
+            self._dirty = True
+
+    def duration(self, out):
+        """Returns how many seconds building out took last time, or None."""
+        history = self._history.get(out)
+        return history[-1][1][0] if history else None
+
+    def history(self, out):
+        """Returns the (time, costs) pairs recorded for out, oldest first."""
+        return list(self._history.get(out, ()))
+
+    def histories(self):
+        """Returns the history() of every output recorded, by output."""
+        return {out: list(history) for out, history in self._history.items()}
+
+    def record_costs(self, out, costs):
+        """Remember that building out has just cost costs, a tuple holding a
+        value for each of COSTS.
+        """
+        history = self._history.setdefault(out, [])
+        history.append((time.time(), tuple(costs)))
+        del history[:-self.HISTORY]
+        self._dirty = True
+
+    def regressions(self, threshold=1.5, min_seconds=0.1):
+        """Returns (output, cost, baseline, latest) for every cost of every
+        output whose latest value exceeds threshold times its baseline, the
+        median of the earlier values kept. Timings below min_seconds are too
+        noisy to tell and are left out.
+        """
+        flagged = []
+        for out, history in sorted(self._history.items()):
+            if len(history) < 2:
+                continue
+            latest = history[-1][1]
+            for i, cost in enumerate(self.COSTS):
+                earlier = sorted(costs[i] for _, costs in history[:-1])
+                baseline = earlier[len(earlier) // 2]
+                if i < 3 and latest[i] < min_seconds:
+                    continue
+                if baseline > 0 and latest[i] > threshold * baseline:
+                    flagged.append((out, cost, baseline, latest[i]))
+        return flagged
+
+    def save(self):
+        """Write the log back to disk if anything was recorded."""
+        if not self._dirty:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as log:
+            pickle.dump((self.VERSION, self._entries, self._history), log, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+class HashCache:
+    """The content hashes of files, each one kept for as long as the file's
+    inode, size and mtime stay the same, and saved to path if there is one.
+    Like git's index, the ctime is compared too, which unlike the mtime no
+    tool can set back after rewriting a file.
+    """
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hashed = 0
+        self._digests = {}
+        self._dirty = False
+        self._todo = queue.Queue()
+        self._workers = []
+        if path is None:
+            return
+        try:
+            with open(path, 'rb') as hashes:
+                version, digests = pickle.load(hashes)
+            if version == self.VERSION:
+                self._digests = digests
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    def digest(self, path):
+        """Returns the sha256 of the file at path, hashing it only if it is
+        new or changed since it was last hashed.
+        """
+        stat = os.stat(path)
+        stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+        known = self._digests.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        digest = _digest(path)
+        self.hashed += 1
+        self._digests[path] = (stamp, digest)
+        self._dirty = True
+        return digest
+
+    def prefetch(self, paths, threads=None):
+        """Hash the files at paths which need it, and return once they are
+        hashed. The files are hashed on a pool of threads threads, by default
+        one per CPU, started by the first call and kept until close().
+        Missing files are skipped.
+        """
+        if not self._workers:
+            for _ in range(threads or os.cpu_count() or 1):
+                worker = threading.Thread(target=self._work, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        for path in paths:
+            self._todo.put(path)
+        self._todo.join()
+
+    def _work(self):
+        while True:
+            path = self._todo.get()
+            try:
+                if path is None:
+                    return
+                self.digest(path)
+            except OSError:
+                pass
+            finally:
+                self._todo.task_done()
+
+    def close(self):
+        """Stop the threads prefetch() started."""
+        for _ in self._workers:
+            self._todo.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def save(self):
+        """Write the hashes back to path if any were added."""
+        if self.path is None or not self._dirty:
+            return
+        # a file changed again within the same tick as it was hashed would go
+        # unnoticed next time, so only keep the hashes of files not changed
+        # just now
+        recent = time.time_ns() - 10 ** 9
+        digests = {path: known for path, known in self._digests.items() if max(known[0][2:]) < recent}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as hashes:
+            pickle.dump((self.VERSION, digests), hashes, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+def _portable(path):
+    """Returns path relative to ABS_DIR_PATH if it is below it, and as it is
+    otherwise.
+    """
+    return os.path.relpath(path, ABS_DIR_PATH) if path.startswith(ABS_DIR_PATH + os.sep) else path
+
+
+class ArtifactCache:
+    """Content-addressed store of built outputs. An output is filed under a
+    hash of its expanded command and the contents of its inputs, and the
+    least recently used entries are evicted once the cache outgrows max_size
+    bytes. Like ccache's base_dir, paths below ABS_DIR_PATH are made relative
+    to it in keys and manifests, so that checkouts of a project at different
+    paths share entries.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_size=5 * 1024 ** 3):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(command, ins):
+        """Returns the cache key of an output built by command from ins."""
+        digest = hashlib.sha256()
+        for arg in command:
+            if ABS_DIR_PATH != os.sep:
+                arg = _relocate(arg, ABS_DIR_PATH, '.')
+            digest.update(arg.encode() + b'\0')
+        for path in ins:
+            with open(path, 'rb') as inp:
+                for chunk in iter(lambda: inp.read(1 << 20), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def fetch(self, key, out):
+        """Restore out from the entry filed under key, as a copy sharing the
+        entry's blocks where the file system allows it or else as a plain
+        copy; never as a hardlink, which a command rewriting out in place
+        would corrupt the entry through. Returns None if there is no such
+        entry, and otherwise the implicit dependencies stored with it.
+        """
+        implicit = []
+        try:
+            manifest = self._entry(key) + '.deps'
+            if os.path.exists(manifest):
+                with open(manifest) as deps:
+                    implicit = [os.path.join(ABS_DIR_PATH, path) for path in deps.read().splitlines()]
+                key = self.key([key], implicit)
+            entry = self._entry(key)
+            tmp = '{}.{}.tmp'.format(out, threading.get_ident())
+            # refreshing the entry's mtime marks it as recently used
+            os.utime(entry)
+            _clone(entry, tmp)
+        except OSError:
+            self.misses += 1
+            return None
+        os.replace(tmp, out)
+        self.hits += 1
+        return implicit
+
+    def store(self, key, out, implicit=None):
+        """File a copy of the freshly built out under key. If the output has
+        implicit dependencies (a list, possibly empty), they are stored in a
+        manifest under key and the output under a key also covering their
+        contents, the way ccache's direct mode handles headers.
+        """
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(entry, threading.get_ident())
+        if implicit is not None:
+            with open(tmp, 'w') as deps:
+                deps.write('\n'.join(map(_portable, implicit)))
+            os.replace(tmp, entry + '.deps')
+            entry = self._entry(self.key([key], implicit))
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(entry, threading.get_ident())
+        shutil.copyfile(out, tmp)
+        os.replace(tmp, entry)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += os.path.getsize(entry)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        for dirname, _, files in os.walk(self.path):
+            for filename in files:
+                path = os.path.join(dirname, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime_ns, stat.st_size, path
+
+    def _evict(self):
+        """Remove least recently used entries until the cache is back under
+        nine tenths of max_size.
+        """
+        for _, size, path in sorted(self._entries()):
+            if self._size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+class HttpCache:
+    """An ArtifactCache shared between machines over HTTP or HTTPS: every
+    entry is fetched with GET and uploaded with PUT at url/key, e.g. from the
+    reference server cache_server() runs. Requests give up after timeout
+    seconds. Once the server could not be reached, the cache is no longer
+    tried for the rest of the build, which then runs every command locally.
+    """
+
+    key = staticmethod(ArtifactCache.key)
+
+    def __init__(self, url, timeout=5.0):
+        # imported here, as http.client takes longer to import than snake
+        import urllib.parse  # pylint: disable=import-outside-toplevel
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise Exception('cache URL must start with http:// or https://: ' + url)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.secure else 80)
+        self.prefix = parts.path.rstrip('/') + '/'
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.down = False
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _request(self, method, key, body=None):
+        """Returns the body of the response to method url/key, or None if
+        there is no such entry or the server cannot be reached.
+        """
+        import http.client  # pylint: disable=import-outside-toplevel
+        if self.down:
+            return None
+        # keep-alive connections are reused by whichever thread asks next
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None and self.secure:
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        elif conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request(method, self.prefix + key, body)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as error:
+            conn.close()
+            if not self.down:
+                self.down = True
+                print("snake: cache {}:{} unreachable ({}), building locally".format(self.host, self.port, error))
+            return None
+        with self._lock:
+            self._idle.append(conn)
+        return data if response.status in (200, 201, 204) else None
+
+    def close(self):
+        """Close the idle connections to the server."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def fetch(self, key, out):
+        """Restore out from the entry filed under key. See
+        ArtifactCache.fetch().
+        """
+        implicit = []
+        data = None
+        try:
+            manifest = self._request('GET', key + '.deps')
+            if manifest is not None:
+                implicit = [os.path.join(ABS_DIR_PATH, path) for path in manifest.decode().splitlines()]
+                key = self.key([key], implicit)
+            data = self._request('GET', key)
+        except OSError:
+            pass
+        if data is None:
+            self.misses += 1
+            return None
+        tmp = '{}.{}.tmp'.format(out, threading.get_ident())
+        with open(tmp, 'wb') as restored:
+            restored.write(data)
+        os.replace(tmp, out)
+        self.hits += 1
+        return implicit
+
+    def store(self, key, out, implicit=None):
+        """Upload the freshly built out under key. See ArtifactCache.store()."""
+        if implicit is not None:
+            self._request('PUT', key + '.deps', '\n'.join(map(_portable, implicit)).encode())
+            key = self.key([key], implicit)
+        with open(out, 'rb') as built:
+            self._request('PUT', key, built.read())
+
+
+class Tracer:
+    """Records the spans of a build (scanning a Dir, checking and running a
+    job) as Chrome trace-event JSON, viewable in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._start = time.perf_counter()
+        self._tids = {}
+
+    @contextmanager
+    def span(self, name, cat):
+        """Time the enclosed block. The yielded dict becomes the span's args."""
+        args = {}
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            tid = self._tids.setdefault(threading.get_ident(), len(self._tids))
+            self.events.append({"name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": tid,
+                                "ts": (start - self._start) * 1e6, "dur": (end - start) * 1e6,
+                                "args": args})
+
+    def write(self, path):
+        """Write the recorded spans to path."""
+        with open(path, 'w') as trace:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace)
+
+
+class _PollWatcher:
+    """Notices changes to a set of files, and entries added to or removed from
+    a set of directories, by stat'ing all of them every interval seconds.
+    """
+
+    def __init__(self, files, dirs, interval=0.5):
+        self.interval = interval
+        self._files, self._dirs = {}, {}
+        self.add(files, dirs)
+
+    def add(self, files, dirs):
+        """Also watch the given files and directories not watched yet."""
+        for path in files:
+            if path not in self._files:
+                self._files[path] = self._stamp(path)
+        for path in dirs:
+            if path not in self._dirs and os.path.isdir(path):
+                self._dirs[path] = set(os.listdir(path))
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def wait(self):
+        """Block until something changed. Returns the changed paths."""
+        while True:
+            time.sleep(self.interval)
+            changed = set()
+            for path, stamp in self._files.items():
+                new = self._stamp(path)
+                if new != stamp:
+                    self._files[path] = new
+                    changed.add(path)
+            for path, names in self._dirs.items():
+                try:
+                    new = set(os.listdir(path))
+                except OSError:
+                    new = set()
+                if new != names:
+                    self._dirs[path] = new
+                    changed.update(os.path.join(path, name) for name in new ^ names)
+            if changed:
+                return changed
+
+    def close(self):
+        """Stop watching."""
+
+
+class _InotifyWatcher:
+    """Like _PollWatcher, but woken up by Linux inotify events on the
+    directories holding the watched files instead of polling.
+    """
+    _MASK = 0x8 | 0x4 | 0x40 | 0x80 | 0x100 | 0x200  # close_write attrib moves create delete
+    _libc = None
+
+    def __init__(self, files, dirs, delay=0.05):
+        # imported here, as ctypes takes longer to import than all of snake
+        import ctypes.util  # pylint: disable=import-outside-toplevel
+        if _InotifyWatcher._libc is None:
+            _InotifyWatcher._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.delay = delay
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._wds = {}
+        self.add(files, dirs)
+
+    def add(self, files, dirs):
+        """Also watch the given files and directories not watched yet."""
+        watched = set(self._wds.values())
+        for path in set(dirs) | set(os.path.dirname(path) for path in files):
+            if path not in watched:
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self._MASK)
+                if wd >= 0:
+                    self._wds[wd] = path
+
+    def _read(self, changed):
+        try:
+            buf = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            wd, _, _, length = struct.unpack_from('iIII', buf, offset)
+            name = buf[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if wd in self._wds and name:
+                changed.add(os.path.join(self._wds[wd], os.fsdecode(name)))
+
+    def wait(self):
+        """Block until something changed. Returns the changed paths."""
+        changed = set()
+        while not changed:
+            select.select([self._fd], [], [])
+            # let a burst of writes (an editor saving, a checkout) settle
+            time.sleep(self.delay)
+            while select.select([self._fd], [], [], 0)[0]:
+                self._read(changed)
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        os.close(self._fd)
+
+
+_OUTPUT_LOCK = threading.Lock()
+
+
+def _emit(stdout, stderr=b''):
+    """Print the captured stdout and stderr of a command to ours, each in
+    one piece, so that the outputs of commands running at the same time
+    never interleave.
+    """
+    if stdout or stderr:
+        with _OUTPUT_LOCK:
+            if stdout:
+                sys.stdout.write(stdout.decode(errors='replace'))
+                sys.stdout.flush()
+            if stderr:
+                sys.stderr.write(stderr.decode(errors='replace'))
+                sys.stderr.flush()
+
+
+# the Linux ioctl making a file share another's blocks, e.g. on Btrfs or XFS
+FICLONE = 0x40049409
+# the kernel's limit on the size of the arguments and environment of a command
+ARG_MAX = os.sysconf('SC_ARG_MAX') if hasattr(os, 'sysconf') else 32768
+
+
+def _fits(args):
+    """Returns whether args, with the environment, stay within ARG_MAX."""
+    # every string also costs a pointer and its terminating NUL
+    size = sum(len(arg) + 9 for arg in args)
+    size += sum(len(key) + len(value) + 10 for key, value in os.environ.items())
+    return size <= ARG_MAX
+
+
+def _quote(path):
+    """Returns path escaped for a gcc-style response file."""
+    return ''.join('\\' + char if char in ' \t\'"\\' else char for char in path)
+
+
+def _clone(src, dst):
+    """Copy src to dst, by reflink where the file system supports one."""
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            shutil.copyfileobj(source, target)
+
+
+def _digest(path):
+    """Returns the sha256 of the contents of the file at path, read through
+    a memory map in chunks, which hashlib hashes without holding the GIL.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as inp:
+        size = os.fstat(inp.fileno()).st_size
+        if size:
+            with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+                for offset in range(0, size, 1 << 20):
+                    digest.update(view[offset:offset + (1 << 20)])
+    return digest.hexdigest()
+
+
+def _send(wfile, header, blobs=()):
+    """Write a message: a length-prefixed JSON header listing the sizes of
+    the blobs, then the blobs themselves.
+    """
+    header = dict(header, sizes=[len(blob) for blob in blobs])
+    data = json.dumps(header).encode()
+    wfile.write(struct.pack('!I', len(data)) + data)
+    for blob in blobs:
+        wfile.write(blob)
+    wfile.flush()
+
+
+def _recv(rfile):
+    """Read a message written by _send. Returns its header and blobs, or
+    None, None once the other end has closed the connection.
+    """
+    prefix = rfile.read(4)
+    if len(prefix) < 4:
+        return None, None
+    header = json.loads(rfile.read(struct.unpack('!I', prefix)[0]).decode())
+    blobs = [rfile.read(size) for size in header['sizes']]
+    if any(len(blob) != size for blob, size in zip(blobs, header['sizes'])):
+        raise EOFError('connection closed mid-message')
+    return header, blobs
+
+
+class LocalExecutor:
+    """Runs commands on this machine. This is what a Session uses unless it
+    is given another executor.
+    """
+    # pylint: disable=too-few-public-methods,unused-argument
+
+    def run(self, args, cwd=None, ins=(), outs=(), depfiles=()):
+        """Run args in cwd, reading the files ins and writing the files outs,
+        among which the depfiles. What the command prints to stdout and to
+        stderr is captured and printed to ours once it exits. Returns the
+        command's resource usage and raises subprocess.CalledProcessError if
+        it fails.
+        """
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            try:
+                return _call(args, cwd, stdout, stderr)
+            finally:
+                stdout.seek(0)
+                stderr.seek(0)
+                _emit(stdout.read(), stderr.read())
+
+
+def _relocate(text, old, new):
+    """Returns text, a str or bytes, with the directory old replaced by new
+    wherever it starts a path: where a separator, whitespace or the end of
+    text follows it, so that e.g. old + '2' stays as it is.
+    """
+    boundary = r'(?![^/\s])'
+    if isinstance(text, bytes):
+        old, new, boundary = old.encode(), new.encode(), boundary.encode()
+    return re.sub(re.escape(old) + boundary, lambda match: new, text)
+
+
+class RemoteExecutor:
+    """Runs commands on Workers over TCP. workers lists their addresses, as
+    'host:port' strings or (host, port) pairs, and each worker is sent up to
+    connections commands at a time; a Session should be given as many jobs.
+
+    Every command is sent with the content hashes of its inputs. The worker
+    asks only for the contents it does not already have, runs the command in
+    a scratch directory standing in for root and sends the outputs back.
+    Paths below root are relocated into that directory, in the arguments too;
+    anything outside root, such as the tools and system headers, is expected
+    at the same place on the workers. A command must therefore list every
+    file below root it reads among its inputs, have read it in the previous
+    build according to its depfile, or find it in shared: files and
+    directories, e.g. of headers, sent along with every command.
+    """
+
+    def __init__(self, workers, root=None, connections=1, shared=()):
+        self.root = os.path.normpath(root or ABS_DIR_PATH)
+        self._shared = []
+        for path in shared:
+            path = path if path[0] == "/" else os.path.join(ABS_DIR_PATH, path)
+            if os.path.isdir(path):
+                self._shared += [os.path.join(dirname, name)
+                                 for dirname, _, files in os.walk(path) for name in files]
+            else:
+                self._shared.append(path)
+        self._hashes = HashCache()
+        self._idle = queue.Queue()
+        for address in workers:
+            if isinstance(address, str):
+                host, _, port = address.rpartition(':')
+                address = (host, int(port))
+            for _ in range(connections):
+                self._idle.put([address, None])
+
+    def run(self, args, cwd=None, ins=(), outs=(), depfiles=()):
+        """Run args on the next idle worker. See LocalExecutor.run()."""
+        slot = self._idle.get()
+        try:
+            # the worker may have dropped a connection left idle, e.g. when
+            # restarted, so a command failing on one is retried once afresh
+            retry = slot[1] is not None
+            while True:
+                if slot[1] is None:
+                    sock = socket.create_connection(slot[0])
+                    slot[1] = (sock, sock.makefile('rb'), sock.makefile('wb'))
+                try:
+                    return self._run(slot[1], args, cwd, ins, outs, depfiles)
+                except (OSError, EOFError):
+                    # reconnect rather than reuse a broken stream
+                    self._disconnect(slot)
+                    if not retry:
+                        raise
+                    retry = False
+        finally:
+            self._idle.put(slot)
+
+    @staticmethod
+    def _disconnect(slot):
+        if slot[1] is not None:
+            for stream in reversed(slot[1]):
+                stream.close()
+            slot[1] = None
+
+    def close(self):
+        """Close the idle connections to the workers."""
+        slots = []
+        while True:
+            try:
+                slots.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for slot in slots:
+            self._disconnect(slot)
+            self._idle.put(slot)
+
+    def _run(self, conn, args, cwd, ins, outs, depfiles):
+        _, rfile, wfile = conn
+        prefix = self.root + os.sep
+        for path in outs:
+            if not path.startswith(prefix):
+                raise Exception('output outside of the remote root: ' + path)
+        inputs = {path: self._hashes.digest(path) for path in list(ins) + self._shared
+                  if path.startswith(prefix) and os.path.exists(path)}
+        _send(wfile, {"args": args, "cwd": cwd, "root": self.root, "inputs": inputs, "outputs": list(outs)})
+        header, _ = _recv(rfile)
+        if header is None:
+            raise EOFError('worker closed the connection')
+        paths = {digest: path for path, digest in inputs.items()}
+        blobs = []
+        for digest in header["missing"]:
+            with open(paths[digest], 'rb') as inp:
+                blobs.append(inp.read())
+        _send(wfile, {}, blobs)
+        header, blobs = _recv(rfile)
+        if header is None:
+            raise EOFError('worker closed the connection')
+        _emit(header["stdout"].encode(), header["stderr"].encode())
+        if header["returncode"]:
+            raise subprocess.CalledProcessError(header["returncode"], args)
+        for path, blob in zip(header["outputs"], blobs):
+            tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+            if path in depfiles:
+                # depfiles name the worker's scratch directory instead of root
+                blob = _relocate(blob, header["scratch"], self.root)
+            with open(tmp, 'wb') as out:
+                out.write(blob)
+            os.replace(tmp, path)
+        return resource.struct_rusage(header["rusage"])
+
+
+class Worker(socketserver.ThreadingTCPServer):
+    """Serves a RemoteExecutor: runs the commands sent to address, one per
+    connection at a time. Inputs are kept by content hash in directory, so
+    that each one is only ever transferred once.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        super().__init__(address, _WorkerHandler)
+
+    def _blob(self, digest):
+        return os.path.join(self.directory, 'blobs', digest)
+
+    def run(self, request, rfile, wfile):
+        """Run one command: fetch its missing inputs, run it in a fresh
+        scratch directory and send back its outputs.
+        """
+        missing = [digest for digest in set(request["inputs"].values())
+                   if not os.path.exists(self._blob(digest))]
+        _send(wfile, {"missing": missing})
+        _, blobs = _recv(rfile)
+        for digest, blob in zip(missing, blobs):
+            if hashlib.sha256(blob).hexdigest() != digest:
+                raise Exception('corrupt input ' + digest)
+            tmp = '{}.{}.tmp'.format(self._blob(digest), threading.get_ident())
+            with open(tmp, 'wb') as out:
+                out.write(blob)
+            os.replace(tmp, self._blob(digest))
+
+        root = request["root"]
+        scratch = tempfile.mkdtemp(dir=self.directory)
+        try:
+            def local(path):
+                return scratch + path[len(root):] if path == root or path.startswith(root + os.sep) else path
+            responses = set(arg[1:] for arg in request["args"] if arg.startswith('@'))
+            for path, digest in request["inputs"].items():
+                os.makedirs(os.path.dirname(local(path)), exist_ok=True)
+                if path in responses:
+                    # response files name paths below root too
+                    with open(self._blob(digest), 'rb') as rsp, open(local(path), 'wb') as out:
+                        out.write(_relocate(rsp.read(), root, scratch))
+                    continue
+                try:
+                    os.link(self._blob(digest), local(path))
+                except OSError:
+                    shutil.copyfile(self._blob(digest), local(path))
+            for path in request["outputs"]:
+                os.makedirs(os.path.dirname(local(path)), exist_ok=True)
+            args = [_relocate(arg, root, scratch) for arg in request["args"]]
+            cwd = local(request["cwd"]) if request["cwd"] else scratch
+            with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+                returncode, usage = 0, None
+                try:
+                    usage = _call(args, cwd, stdout, stderr)
+                except subprocess.CalledProcessError as error:
+                    returncode = error.returncode
+                except OSError as error:
+                    returncode = 127
+                    stderr.write('{}\n'.format(error).encode())
+                stdout.seek(0)
+                stderr.seek(0)
+                reply = {"returncode": returncode, "rusage": usage and list(usage), "scratch": scratch,
+                         "stdout": stdout.read().decode(errors='replace'),
+                         "stderr": stderr.read().decode(errors='replace')}
+            outputs = []
+            blobs = []
+            if not returncode:
+                for path in request["outputs"]:
+                    if os.path.exists(local(path)):
+                        with open(local(path), 'rb') as out:
+                            blobs.append(out.read())
+                        outputs.append(path)
+            reply["outputs"] = outputs
+            _send(wfile, reply, blobs)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            request, _ = _recv(self.rfile)
+            if request is None:
+                return
+            self.server.run(request, self.rfile, self.wfile)
+
+
+def cache_server(address, directory):
+    """Returns a reference HttpCache server for address, keeping its entries
+    in directory. Call its serve_forever() to serve it.
+    """
+    # imported here, as http.server takes longer to import than snake
+    import http.server  # pylint: disable=import-outside-toplevel
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _path(self):
+            key = self.path.rsplit('/', 1)[-1]
+            name = key[:-len('.deps')] if key.endswith('.deps') else key
+            if len(name) != 64 or name.strip('0123456789abcdef'):
+                self._reply(400)
+                return None
+            return os.path.join(directory, key[:2], key)
+
+        def _reply(self, status, body=b''):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            path = self._path()
+            if path is None:
+                return
+            try:
+                with open(path, 'rb') as entry:
+                    body = entry.read()
+            except OSError:
+                self._reply(404)
+                return
+            self._reply(200, body)
+
+        def do_PUT(self):  # pylint: disable=invalid-name
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            path = self._path()
+            if path is None:
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(tmp, 'wb') as entry:
+                entry.write(body)
+            os.replace(tmp, path)
+            self._reply(201)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    os.makedirs(directory, exist_ok=True)
+    return http.server.ThreadingHTTPServer(address, Handler)
+
+
+class _Job:
+    """A single command of the build graph: the Target producing out. ins is
+    a tuple of interned paths, and deps an array of the indices of the jobs
+    producing some of them in the Session's list of planned jobs.
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('index', 'out', 'tool', 'ins', 'deps', 'stamps', 'depfile', 'implicit', 'duration',
+                 'digest', 'costs')
+
+    def __init__(self, out, tool):
+        self.index = None
+        self.out = out
+        self.tool = tool
+        self.ins = ()
+        self.deps = array('l')
+        self.stamps = None
+        self.depfile = tool._depfile.format(out=out) if tool._depfile else None
+        self.implicit = ()
+        self.duration = 0.0
+        self.digest = None
+        self.costs = None
+
+    def command(self):
+        """Return the argument list that builds this job's output."""
+        return self.tool.argv(self.ins, (self.out,))
+
+
+class Session:
+    """Plans the whole dependency graph below the nodes being built, then runs
+    every stale command once its dependencies are up to date. Up to jobs
+    commands which do not depend on one another run at the same time.
+
+    Every Target, Dir and output path is evaluated at most once per session,
+    so a node shared by many dependents is scanned and checked only once.
+    Likewise every path is stat'ed at most once, through the StatCache
+    stats, except for outputs rewritten by a command.
+
+    Unless log is False, the command and input stamps of every output are
+    kept in a BuildLog (by default .snake_log next to the snakefile), so an
+    output is also rebuilt when its command or inputs changed since then.
+
+    cache may be an ArtifactCache, the directory of one, or True for the
+    default one in CACHE_DIR, or an HttpCache or its http:// or https://
+    URL; stale outputs are then restored from it instead of being rebuilt
+    whenever an identical build was cached before.
+
+    With trace set to a file name, the build is traced into it in Chrome
+    trace-event format, and the critical path and the top slowest commands
+    are printed once it finishes.
+
+    Commands are run by executor, a LocalExecutor unless given e.g. a
+    RemoteExecutor spreading them over several machines.
+
+    With restat, a rebuilt output whose contents came out the same as before
+    keeps its old mtime, so that the outputs depending on it are not rebuilt
+    in turn. The content hashes this compares are kept in the build log.
+
+    A failed command stops the build, unless keep_going is set: then
+    everything that does not depend on a failed command is still built, and
+    all failures are reported together at the end.
+
+    With content set, inputs are compared by content instead of by mtime
+    with those an output was last built from, so that touching a file, or
+    checking out or unpacking an unchanged one, rebuilds nothing. Their
+    hashes are kept in a HashCache next to the build log.
+    """
+
+    def __init__(self, jobs=1, log=True, cache=None, trace=None, top=10, executor=None, restat=False,
+                 keep_going=False, content=False):
+        if jobs < 1:
+            raise Exception('jobs must be at least 1')
+        if (restat or content) and not log:
+            raise Exception('restat and content need the build log')
+        self._restat = restat
+        self._keep_going = keep_going
+        self.cutoffs = 0
+        self.jobs = jobs
+        if log is True:
+            log = os.path.join(ABS_DIR_PATH, LOG_NAME)
+        self._log = BuildLog(log) if log else None
+        self._hashes = HashCache(os.path.join(os.path.dirname(log), HASH_NAME)) if content else None
+        self.stats = StatCache()
+        if cache is True:
+            cache = ArtifactCache()
+        elif isinstance(cache, str) and '://' in cache:
+            cache = HttpCache(cache)
+        elif isinstance(cache, str):
+            cache = ArtifactCache(cache)
+        self._cache = cache
+        self._trace = trace
+        self._tracer = Tracer() if trace else None
+        self._top = top
+        self._executor = executor or LocalExecutor()
+        self._pools = {}
+        self._jobs = {}
+        self._planned = []
+        self._order = []
+        self._resolved = {}
+        # id of a Dir -> indices of the jobs depending on it, and directory
+        # scanned by a Dir -> ids of the Dirs scanning it
+        self._dir_jobs = {}
+        self._dir_ids = {}
+        # directory scanned by a Dir registered with target() -> its names,
+        # as no job may be left to depend on such a Dir
+        self._dir_targets = {}
+        self._readers = None
+
+    def build(self, *nodes):
+        """Build the given nodes (Targets or Dirs) and everything they depend
+        on. Returns a list holding what each node's own build() returns.
+        """
+        for node in nodes:
+            if not isinstance(node, Dir):
+                self._resolve(node, node._tool if node.has_tool() else None)
+        # Dirs nothing else depends on are scanned while their files build
+        streamed = {id(node): node for node in nodes if isinstance(node, Dir) and id(node) not in self._resolved}
+        self._run(list(streamed.values()))
+        results = []
+        for node in nodes:
+            if isinstance(node, Dir):
+                results.append([item.out if isinstance(item, _Job) else item for item in self._resolved[id(node)][1]])
+            else:
+                results.append(node._out)
+        return results
+
+    def _resolve(self, node, tool):
+        """Returns the flattened inputs node contributes to its dependents: a
+        path for every file and a _Job for every Target. Jobs are recorded in
+        dependency order, sharing one job per output path. The graph below
+        node is walked with a stack of its own rather than by recursion, so
+        that chains of any length can be planned.
+        """
+        if isinstance(node, str):
+            return [node]
+        if isinstance(node, Leaf):
+            return [node._out]
+        top = node
+        # (node, tool it inherits, whether its dependencies are planned by
+        # now, its job if a Target or its files if a Dir) still to plan, and
+        # the ids of the nodes whose dependencies are being planned
+        stack = [(node, tool, False, None)]
+        active = set()
+        while stack:
+            node, tool, expanded, found = stack.pop()
+            # keep node alive alongside its result so that its id stays unique
+            if id(node) in self._resolved:
+                continue
+            if expanded:
+                active.discard(id(node))
+                if isinstance(node, Dir):
+                    # files are resolved straight to paths and jobs; the Leaf and
+                    # Target objects Dir._contents() would wrap them in are not needed
+                    items = self._items(node, tool, found)
+                else:
+                    self._plan_job(found, node.dependencies)
+                    items = [found]
+                self._resolved[id(node)] = (node, items)
+                continue
+            if id(node) in active:
+                raise Exception('dependency cycle through ' + (node.path if isinstance(node, Dir) else node._out))
+
+            deps = node.dependencies
+            if isinstance(node, Dir):
+                tool = node._tool if node.has_tool() else tool
+                with self._span(node.path, 'scan'):
+                    found = node._get_files(self.stats)
+                # only the jobs of mapped files depend on a Dir's dependencies
+                if not any(node._map(path) is not None for path in found):
+                    deps = ()
+            else:
+                if node._out is None:
+                    raise Exception('out was never specified')
+                if node.has_tool():
+                    tool = node._tool
+                if tool is None:
+                    raise Exception('no tool specified for target')
+                found = self._jobs.get(node._out)
+                if found is not None:
+                    if found.index is None:
+                        raise Exception('dependency cycle through ' + node._out)
+                    self._resolved[id(node)] = (node, [found])
+                    continue
+                found = self._new_job(node._out, tool)
+            active.add(id(node))
+            stack.append((node, tool, True, found))
+            for dep in reversed(deps):
+                if isinstance(dep, (Target, Dir)) and id(dep) not in self._resolved:
+                    stack.append((dep, tool, False, None))
+        return self._resolved[id(top)][1]
+
+    def _items(self, node, tool, files):
+        """Returns the paths and jobs the files of the Dir node resolve to."""
+        items = []
+        for path in files:
+            out = node._map(path)
+            if out is None:
+                items.append(sys.intern(path))
+            else:
+                if tool is None:
+                    raise Exception('no tool specified for target')
+                out = out if out[0] == "/" else os.path.join(ABS_DIR_PATH, out)
+                items.append(self._job(out, tool, [path] + node.dependencies))
+        return items
+
+    def _job(self, out, tool, deps):
+        """Returns the job building out, planning it first with the given
+        dependencies (Targets, Dirs, Leafs or paths) if it is new.
+        """
+        job = self._jobs.get(out)
+        if job is not None:
+            if job.index is None:
+                raise Exception('dependency cycle through ' + out)
+            return job
+        job = self._new_job(out, tool)
+        self._plan_job(job, deps)
+        return job
+
+    def _new_job(self, out, tool):
+        """Returns a new job building out, known by its output but not
+        planned yet.
+        """
+        if tool._pool is not None:
+            depth = self._pools.setdefault(tool._pool, tool._pool_depth)
+            if depth != tool._pool_depth:
+                raise Exception('pool {} given depths {} and {}'.format(tool._pool, depth, tool._pool_depth))
+        out = sys.intern(out)
+        job = _Job(out, tool)
+        self._jobs[out] = job
+        return job
+
+    def _plan_job(self, job, deps):
+        """Plan job with the given dependencies, which are resolved by now."""
+        ins = []
+        indices = {}
+        for dep in deps:
+            for item in self._resolve(dep, job.tool):
+                if isinstance(item, _Job):
+                    if item.index is None:
+                        raise Exception('dependency cycle through ' + item.out)
+                    indices[item.index] = None
+                    ins.append(item.out)
+                else:
+                    ins.append(sys.intern(item))
+        job.ins = tuple(ins)
+        job.deps = array('l', indices)
+        job.index = len(self._planned)
+        self._planned.append(job)
+        self._order.append(job)
+        for dep in deps:
+            if isinstance(dep, Dir):
+                indices = self._dir_jobs.get(id(dep))
+                if indices is None:
+                    # each Dir's directories are listed once, not once per job
+                    indices = self._dir_jobs[id(dep)] = []
+                    for dirname in dep._dirs():
+                        self._dir_ids.setdefault(dirname, []).append(id(dep))
+                indices.append(job.index)
+        self._readers = None
+
+    def watch(self, *nodes, interval=0.5, poll=False, rebuilds=None):
+        """Build the given nodes, then keep watching their source files and
+        the directories of their Dirs and rebuild what is downstream of every
+        change, until interrupted or after rebuilds rebuilds. The graph and
+        the stat cache stay in memory between builds: a changed file only has
+        the jobs depending on it checked again, while adding a file to or
+        removing one from a Dir has the graph planned anew. Changes are
+        noticed with inotify on Linux, and by polling every interval seconds
+        elsewhere or with poll set. Failed builds are reported, not raised.
+        """
+        count = 0
+        replan = True
+        watcher = None
+        try:
+            while True:
+                if replan:
+                    if watcher is not None:
+                        watcher.close()
+                    self._jobs, self._planned, self._order, self._resolved = {}, [], [], {}
+                    self._dir_jobs, self._dir_ids, self._readers = {}, {}, None
+                    self.stats = StatCache()
+                    for node in nodes:
+                        self._resolve(node, node._tool if node.has_tool() else None)
+                    sources, dirs = self._sources()
+                    watcher = None
+                    if not poll and sys.platform.startswith('linux'):
+                        try:
+                            watcher = _InotifyWatcher(sources, dirs)
+                        except OSError:
+                            pass
+                    if watcher is None:
+                        watcher = _PollWatcher(sources, dirs, interval)
+
+                try:
+                    self._run()
+                except Exception as error:  # pylint: disable=broad-except
+                    print("snake: build failed: {}".format(error))
+                if rebuilds is not None and count >= rebuilds:
+                    return
+                count += 1
+
+                # the run read the depfiles, which may name files not watched yet
+                sources, dirs = self._sources()
+                watcher.add(sources, dirs)
+                affected = set()
+                replan = False
+                while not affected and not replan:
+                    for path in watcher.wait():
+                        self.stats.invalidate(path)
+                        if path in sources:
+                            if os.path.exists(path):
+                                affected.update(sources[path])
+                            else:
+                                replan = True
+                        elif (path not in self._jobs and os.path.dirname(path) in dirs
+                              and os.path.basename(path)[0] != '.'):
+                            replan = True
+                self._order = self._downstream(affected)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def _sources(self):
+        """Returns the files the planned jobs read but no job writes, mapped
+        to the jobs reading them, and the directories scanned by Dirs.
+        """
+        sources = {}
+        for job in self._planned:
+            for path in job.ins + job.implicit:
+                if path not in self._jobs:
+                    sources.setdefault(path, []).append(job)
+        dirs = set()
+        for node, _ in self._resolved.values():
+            if isinstance(node, Dir):
+                dirs.update(node._dirs())
+        return sources, dirs
+
+    def _downstream(self, jobs):
+        """Returns the planned jobs that are in jobs or depend on one of them,
+        directly or not, in dependency order.
+        """
+        affected = set(job.index for job in jobs)
+        downstream = []
+        for job in self._planned:
+            if job.index in affected or any(dep in affected for dep in job.deps):
+                affected.add(job.index)
+                downstream.append(job)
+        return downstream
+
+    def _span(self, name, cat):
+        """A Tracer span, or a no-op when not tracing."""
+        if self._tracer is None:
+            return nullcontext({})
+        return self._tracer.span(name, cat)
+
+    def _stale(self, job):
+        """Returns why job's output must be rebuilt, or None if it is up to
+        date: when it is missing, or its command, inputs or input stamps
+        differ from the ones logged when it was last built. Outputs without a
+        log entry are stale when older than any of their inputs.
+        """
+        job.stamps = None
+        job.digest = None
+        for path in job.ins:
+            if not self.stats.exists(path):
+                return 'missing input ' + path
+        job.stamps = tuple(self._stamp(path) for path in job.ins)
+        if not self.stats.exists(job.out):
+            return 'missing output'
+        entry = self._log.get(job.out) if self._log else None
+        if entry is None:
+            if job.depfile and self.stats.exists(job.depfile):
+                job.implicit = self._implicit(job)
+            ins = job.ins + tuple(dep for dep in job.implicit if self.stats.exists(dep))
+            for path in ins:
+                if any_newer(path, job.out, self.stats):
+                    return 'newer input ' + path
+            return None
+        command, ins, stamps, implicit, implicit_stamps, _, job.digest = entry
+        if command != tuple(job.command()):
+            return 'changed command'
+        if ins != job.ins:
+            return 'changed inputs'
+        if stamps != job.stamps:
+            return 'changed input ' + next(path for path, old, new in zip(ins, stamps, job.stamps)
+                                           if old != new)
+        job.implicit = implicit
+        for dep, stamp in zip(implicit, implicit_stamps):
+            if not self.stats.exists(dep) or self._stamp(dep) != stamp:
+                return 'changed dependency ' + dep
+        return None
+
+    def _stamp(self, path):
+        """Returns what the build log records of the file at path to tell
+        whether it changed: its content hash or its mtime.
+        """
+        if self._hashes is not None:
+            return self._hashes.digest(path)
+        return self.stats.mtime_ns(path)
+
+    def _prefetch(self, jobs):
+        """Hash the inputs of jobs in parallel, ahead of checking them one
+        by one, when comparing contents. The outputs of jobs are left out,
+        as they may yet be rebuilt.
+        """
+        if self._hashes is None:
+            return
+        outs = set(job.out for job in jobs)
+        paths = set()
+        for job in jobs:
+            paths.update(job.ins)
+            entry = self._log.get(job.out)
+            if entry is not None:
+                paths.update(entry[3])
+        self._hashes.prefetch(path for path in paths if path not in outs)
+
+    def plan(self, *nodes):
+        """Returns the commands building the given nodes would run, in the
+        order they would run in, as (output, command, reason) tuples. Nothing
+        is run: a job whose inputs are up to date is listed as well when a
+        job it depends on is.
+        """
+        for node in nodes:
+            self._resolve(node, node._tool if node.has_tool() else None)
+        return self._steps()
+
+    def _steps(self):
+        """Returns the plan() of the jobs planned since the last run."""
+        self._prefetch(self._order)
+        if self._hashes is not None:
+            self._hashes.close()
+        stale = set()
+        steps = []
+        for job in self._order:
+            reason = self._stale(job)
+            rebuilt = [dep for dep in job.deps if dep in stale]
+            if rebuilt and (reason is None or reason.startswith('missing input')):
+                reason = 'rebuilt dependency ' + self._planned[rebuilt[0]].out
+            if reason is not None:
+                stale.add(job.index)
+                steps.append((job.out, job.command(), reason))
+        return steps
+
+    def load(self, snakefile):
+        """Plans the targets snakefile registers with target(), and returns
+        the indices of the planned jobs every one of them names, by name.
+        The planned graph is cached in GRAPH_NAME next to snakefile and
+        loaded from there instead, without running snakefile or scanning
+        any Dir, for as long as neither snakefile, nor the modules below
+        its directory it imports, nor the directories its Dirs scanned have
+        changed, and snakefile is still in the same directory. Graphs
+        scanning directories outside of snakefile's are not cached, and
+        neither is anything else snakefile reads taken into account, such
+        as modules imported from elsewhere or the environment.
+        """
+        graph = os.path.join(os.path.dirname(snakefile), GRAPH_NAME)
+        with open(snakefile, 'rb') as source:
+            code = source.read()
+        # the graph holds absolute paths, so a copy of the tree must not use it
+        key = hashlib.sha256(code + b'\0' + ABS_DIR_PATH.encode()).hexdigest()
+        try:
+            with open(graph, 'rb') as cached:
+                version, cached_key, stamps, targets, planned, dir_jobs, dir_ids, dir_targets = pickle.load(cached)
+            if (version == GRAPH_VERSION and cached_key == key and all(map(self._below_root, stamps))
+                    and all(os.stat(path).st_mtime_ns == mtime for path, mtime in stamps.items())):
+                self._planned = planned
+                self._dir_jobs = dir_jobs
+                self._dir_ids = dir_ids
+                self._dir_targets = dir_targets
+                self._jobs = {job.out: job for job in planned}
+                for job in planned:
+                    if job.tool._pool is not None:
+                        self._pools[job.tool._pool] = job.tool._pool_depth
+                return targets
+        except (OSError, EOFError, ValueError, AttributeError, pickle.UnpicklingError):
+            pass
+
+        _TARGETS.clear()
+        modules = set(sys.modules)
+        exec(compile(code, snakefile, 'exec'), {'__name__': '__snakefile__', '__file__': snakefile})
+        imported = [getattr(sys.modules[name], '__file__', None) for name in set(sys.modules) - modules]
+        targets = {}
+        for name, node in _TARGETS.items():
+            items = self._resolve(node, node._tool if node.has_tool() else None)
+            targets[name] = [item.index for item in items if isinstance(item, _Job)]
+            if isinstance(node, Dir):
+                for dirname in node._dirs():
+                    self._dir_targets.setdefault(dirname, []).append(name)
+        self._order = []
+        paths = self._sources()[1]
+        paths.update(os.path.realpath(path) for path in imported if path and self._below_root(os.path.realpath(path)))
+        stamps = {path: os.stat(path).st_mtime_ns for path in paths}
+        # like _list_dir(), do not trust listings of directories changed just now
+        if (all(map(self._below_root, stamps))
+                and all(mtime < time.time_ns() - 10 ** 9 for mtime in stamps.values())):
+            tmp = graph + '.tmp'
+            with open(tmp, 'wb') as cached:
+                pickle.dump((GRAPH_VERSION, key, stamps, targets, self._planned, self._dir_jobs,
+                             self._dir_ids, self._dir_targets), cached, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, graph)
+        return targets
+
+    @staticmethod
+    def _below_root(path):
+        """Returns whether path is ABS_DIR_PATH or below it."""
+        return path == ABS_DIR_PATH or path.startswith(ABS_DIR_PATH + os.sep)
+
+    def affected(self, changed, *nodes):
+        """Returns the outputs, in dependency order, of the planned jobs that
+        may need rebuilding after the files at the paths changed were
+        changed, added or removed: those reading one of them, directly, as
+        an implicit dependency or as a file of a Dir, and those downstream
+        of these. The given nodes are planned first. Nothing is stat'ed or
+        run, so that the answer only depends on the planned graph.
+        """
+        for node in nodes:
+            self._resolve(node, node._tool if node.has_tool() else None)
+        self._order = []
+        return [self._planned[index].out for index in self._affected(changed)]
+
+    def _affected(self, changed):
+        """Returns the sorted indices of the jobs affected(changed) lists."""
+        if self._readers is None:
+            self._readers = self._index()
+        seen = set()
+        paths = []
+        for path in changed:
+            path = path if path[0] == "/" else os.path.join(ABS_DIR_PATH, path)
+            paths += [path, os.path.normpath(path)]
+            # a file added to or removed from a Dir changes what it contains
+            for key in self._dir_ids.get(os.path.dirname(os.path.normpath(path)), ()):
+                for index in self._dir_jobs[key]:
+                    if index not in seen:
+                        seen.add(index)
+                        paths.append(self._planned[index].out)
+        while paths:
+            for index in self._readers.get(paths.pop(), ()):
+                if index not in seen:
+                    seen.add(index)
+                    paths.append(self._planned[index].out)
+        return sorted(seen)
+
+    def _index(self):
+        """Returns the reverse-dependency index of the planned graph: every
+        path read by a job mapped to the indices of the jobs reading it.
+        """
+        readers = {}
+        for job in self._planned:
+            implicit = job.implicit
+            if not implicit and self._log is not None:
+                entry = self._log.get(job.out)
+                implicit = entry[3] if entry is not None else ()
+            for path in job.ins + implicit:
+                readers.setdefault(path, []).append(job.index)
+        return readers
+
+    def _needed(self, roots):
+        """Returns the planned jobs that the jobs with indices roots depend
+        on, directly or not, and those jobs themselves, in dependency order.
+        """
+        needed = set(roots)
+        for job in reversed(self._planned):
+            if job.index in needed:
+                needed.update(job.deps)
+        return [job for job in self._planned if job.index in needed]
+
+    @staticmethod
+    def _implicit(job):
+        """Returns the dependencies job's depfile lists beyond its inputs."""
+        ins = set(job.ins)
+        return tuple(dep for dep in parse_depfile(job.depfile) if dep not in ins)
+
+    def _execute(self, jobs):
+        """Like _produce(), but with restat every output whose contents did not
+        change gets its previous mtime back.
+        """
+        if not self._restat:
+            for job in jobs:
+                job.digest = None
+            self._produce(jobs)
+            return
+        before = [self._output(job) for job in jobs]
+        self._produce(jobs)
+        for job, old in zip(jobs, before):
+            job.digest = _digest(job.out)
+            if old is not None and old[1] == job.digest:
+                stat = os.stat(job.out)
+                os.utime(job.out, ns=(stat.st_atime_ns, old[0]))
+                self.cutoffs += 1
+
+    def _output(self, job):
+        """Returns the mtime and content hash of job's output as it is before
+        running its command, or None if it does not exist. The hash comes
+        from the log while the output still has the logged stamp.
+        """
+        try:
+            mtime = os.stat(job.out).st_mtime_ns
+        except OSError:
+            return None
+        entry = self._log.get(job.out)
+        if entry is not None and entry[5] == mtime:
+            return mtime, entry[6]
+        return mtime, _digest(job.out)
+
+    def _produce(self, jobs):
+        """Bring the outputs of jobs up to date. Every output the artifact
+        cache holds a matching entry for is restored from it. A single job
+        runs its own command; the jobs of a batch tool share one command over
+        all of their inputs and outputs, run in the outputs' directory.
+        """
+        keys = {}
+        if self._cache is not None:
+            missing = []
+            for job in jobs:
+                key = self._cache.key(job.command(), job.ins)
+                implicit = self._cache.fetch(key, job.out)
+                if implicit is not None:
+                    job.implicit = implicit
+                    continue
+                keys[job] = key
+                missing.append(job)
+            if not missing:
+                return
+            jobs = missing
+        for job in jobs:
+            if job.depfile and os.path.exists(job.depfile):
+                os.remove(job.depfile)
+
+        tool = jobs[0].tool
+        ins = []
+        implicit = []
+        depfiles = [job.depfile for job in jobs if job.depfile]
+        for job in jobs:
+            ins += job.ins
+            implicit += job.implicit
+        ins = list(dict.fromkeys(ins))
+        outs = [job.out for job in jobs]
+        command = tool.argv(ins, outs)
+        cwd = os.path.dirname(outs[0]) if tool._batch is not None else None
+        response = None
+        if not _fits(command):
+            response = outs[0] + '.rsp'
+            with open(response, 'w') as rsp:
+                rsp.write(''.join(_quote(path) + '\n' for path in ins))
+            command = tool.argv(ins, outs, response)
+            implicit.append(response)
+        # what the command reads and writes, for executors running it elsewhere
+        files = (list(dict.fromkeys(ins + implicit)), outs + depfiles, depfiles)
+        start = time.perf_counter()
+        with self._span(" ".join(outs), 'run') as args:
+            usage = self._executor.run(command, cwd, *files)
+            args["cpu"] = usage.ru_utime + usage.ru_stime
+            args["maxrss"] = usage.ru_maxrss
+        # like ninja, keep the response file of a failed command to debug it
+        if response is not None:
+            os.remove(response)
+        duration = time.perf_counter() - start
+        # the jobs of a batch share its costs, except for the peak memory
+        share = len(jobs)
+        for job in jobs:
+            job.duration = duration
+            job.costs = (duration, usage.ru_utime / share, usage.ru_stime / share, usage.ru_maxrss,
+                         usage.ru_inblock / share, usage.ru_oublock / share)
+
+        for job in jobs:
+            if job.depfile:
+                job.implicit = self._implicit(job)
+            if job in keys:
+                self._cache.store(keys[job], job.out, job.implicit if job.depfile else None)
+
+    def _done(self, job):
+        """Log how job's output was brought up to date."""
+        if self._log is not None and job.costs is not None:
+            self._log.record_costs(job.out, job.costs)
+            job.costs = None
+        if self._log is not None and job.stamps is not None:
+            implicit = [dep for dep in job.implicit if self.stats.exists(dep)]
+            self._log.record(job.out, tuple(job.command()), job.ins, job.stamps,
+                             implicit, tuple(self._stamp(dep) for dep in implicit),
+                             self.stats.mtime_ns(job.out) if job.digest else None, job.digest)
+
+    def _run(self, dirs=()):
+        """Run the stale jobs planned since the last run, each one only after
+        all of its dependencies have finished and while its tool's pool has
+        room for one more command. Of the jobs that could start, the ones
+        heading the longest chains of remaining work go first; see
+        _priorities(). On the first failure no new commands are started,
+        unless keeping going; the ones already running are waited for and the
+        error is re-raised. Keeping going, the jobs depending on a failed one
+        never become ready, and an error listing every failure is raised once
+        nothing else can run.
+        The Dirs in dirs, which must not have been resolved yet, are scanned
+        on a thread of their own meanwhile: the files of every directory
+        listed are planned and checked right away, and start building while
+        the scan goes on.
+        """
+        pending, self._order = self._order, []
+        self._prefetch(pending)
+        # pending job positions, and who depends on whom among them as a CSR
+        # adjacency: the dependents of position i are
+        # dependents[offsets[i]:offsets[i + 1]]
+        position = {job.index: i for i, job in enumerate(pending)}
+        waiting = array('l', [0]) * len(pending)
+        offsets = array('l', [0]) * (len(pending) + 1)
+        for i, job in enumerate(pending):
+            for dep in job.deps:
+                if dep in position:
+                    waiting[i] += 1
+                    offsets[position[dep] + 1] += 1
+        for i in range(len(pending)):
+            offsets[i + 1] += offsets[i]
+        dependents = array('l', [0]) * offsets[-1]
+        fill = offsets[:-1]
+        for i, job in enumerate(pending):
+            for dep in job.deps:
+                if dep in position:
+                    dependents[fill[position[dep]]] = i
+                    fill[position[dep]] += 1
+        priority = self._priorities(pending, offsets, dependents)
+        # heaps of (-priority, position) and of (-priority, sequence, jobs)
+        ready = [(-priority[i], i) for i in range(len(pending)) if not waiting[i]]
+        heapq.heapify(ready)
+        runnable = []
+        finished = bytearray(len(pending))
+        # position -> positions of the jobs added since the start depending on it
+        later = {}
+
+        def release(dependent):
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                heapq.heappush(ready, (-priority[dependent], dependent))
+
+        def finish(job):
+            self._done(job)
+            i = position[job.index]
+            finished[i] = 1
+            if i < len(offsets) - 1:
+                for k in range(offsets[i], offsets[i + 1]):
+                    release(dependents[k])
+            for dependent in later.pop(i, ()):
+                release(dependent)
+
+        def add(jobs):
+            # jobs planned while running, after the jobs they depend on
+            if not jobs:
+                return
+            self._prefetch(jobs)
+            estimates = self._priorities(jobs, array('l', [0]) * (len(jobs) + 1), array('l'))
+            for job, estimate in zip(jobs, estimates):
+                i = len(pending)
+                pending.append(job)
+                position[job.index] = i
+                priority.append(estimate)
+                finished.append(0)
+                waiting.append(0)
+                for dep in job.deps:
+                    k = position.get(dep)
+                    if k is not None and not finished[k]:
+                        waiting[i] += 1
+                        later.setdefault(k, []).append(i)
+                if not waiting[i]:
+                    heapq.heappush(ready, (-estimate, i))
+                if job.tool._pool is not None:
+                    in_use.setdefault(job.tool._pool, 0)
+
+        def schedule(jobs):
+            heapq.heappush(runnable, (-max(priority[position[job.index]] for job in jobs), next(sequence), jobs))
+
+        sequence = itertools.count()
+        failures = []
+        stop = False
+        running = 0
+        # commands running per pool
+        in_use = dict.fromkeys(self._pools, 0)
+        # up to jobs threads, started as needed, take batches of jobs from
+        # todo and put them into done along with their error, if any
+        todo = queue.Queue()
+        done = queue.Queue()
+        threads = []
+
+        def work():
+            while True:
+                jobs = todo.get()
+                if jobs is None:
+                    return
+                try:
+                    self._execute(jobs)
+                except BaseException as error:  # pylint: disable=broad-except
+                    done.put((jobs, error))
+                else:
+                    done.put((jobs, None))
+
+        # the scanner puts (None, (dir, listing)) into done for every
+        # directory listed, with at most so many listings not yet planned,
+        # and (None, error) once done
+        listings = {id(node): {} for node in dirs}
+        slots = threading.Semaphore(4 * WALK_THREADS)
+        cancel = threading.Event()
+
+        def scan():
+            try:
+                for node in dirs:
+                    with self._span(node.path, 'scan'):
+                        for listing in node._walk():
+                            slots.acquire()
+                            if cancel.is_set():
+                                return
+                            done.put((None, (node, listing)))
+            except BaseException as error:  # pylint: disable=broad-except
+                done.put((None, error))
+            else:
+                done.put((None, None))
+
+        def plan(node, listing):
+            dirname, files, subdirs = listing
+            for path in files:
+                self.stats.add(path)
+            items = self._items(node, node._tool if node.has_tool() else None, files)
+            listings[id(node)][dirname] = (items, subdirs)
+            jobs, self._order = self._order, []
+            add(jobs)
+
+        scanner = None
+        scanning = bool(dirs)
+        if scanning:
+            scanner = threading.Thread(target=scan, daemon=True)
+            scanner.start()
+
+        try:
+            while ready or runnable or running or scanning:
+                batches = {}
+                while ready and not stop:
+                    job = pending[heapq.heappop(ready)[1]]
+                    with self._span(job.out, 'check'):
+                        stale = self._stale(job)
+                    if stale is None:
+                        finish(job)
+                    elif job.tool._batch is None:
+                        schedule([job])
+                    else:
+                        key = (job.tool, os.path.dirname(job.out))
+                        batches.setdefault(key, []).append(job)
+                for (tool, _), jobs in batches.items():
+                    for i in range(0, len(jobs), tool._batch):
+                        schedule(jobs[i:i + tool._batch])
+
+                full = []
+                while runnable and not stop and running < self.jobs:
+                    entry = heapq.heappop(runnable)
+                    jobs = entry[2]
+                    name = jobs[0].tool._pool
+                    if name is not None:
+                        if in_use[name] >= self._pools[name]:
+                            full.append(entry)
+                            continue
+                        in_use[name] += 1
+                    if len(threads) == running:
+                        threads.append(threading.Thread(target=work, daemon=True))
+                        threads[-1].start()
+                    todo.put(jobs)
+                    running += 1
+                for entry in full:
+                    heapq.heappush(runnable, entry)
+                if not running and (stop or not scanning):
+                    break
+                jobs, error = done.get()
+                if jobs is None:
+                    if isinstance(error, tuple):
+                        slots.release()
+                        plan(*error)
+                        continue
+                    scanning = False
+                    if error is not None:
+                        raise error
+                    for node in dirs:
+                        self._resolved[id(node)] = (node, node._ordered(listings[id(node)]))
+                    continue
+                running -= 1
+                if jobs[0].tool._pool is not None:
+                    in_use[jobs[0].tool._pool] -= 1
+                for job in jobs:
+                    self.stats.invalidate(job.out)
+                if error is not None:
+                    failures.append((jobs, error))
+                    stop = not self._keep_going
+                else:
+                    for job in jobs:
+                        finish(job)
+        finally:
+            if scanner is not None:
+                cancel.set()
+                slots.release()
+                scanner.join()
+            # let the commands still running finish, e.g. after an interrupt
+            for _ in threads:
+                todo.put(None)
+            for thread in threads:
+                thread.join()
+            if self._log is not None:
+                self._log.save()
+            if self._hashes is not None:
+                self._hashes.close()
+                self._hashes.save()
+            if isinstance(self._cache, HttpCache):
+                self._cache.close()
+            if isinstance(self._executor, RemoteExecutor):
+                self._executor.close()
+            if self._tracer is not None:
+                self._tracer.write(self._trace)
+                self._report()
+        if len(failures) == 1:
+            raise failures[0][1]
+        if failures:
+            raise Exception('{} commands failed:\n'.format(len(failures)) + '\n'.join(
+                '  {}: {}'.format(" ".join(job.out for job in jobs), error) for jobs, error in failures))
+
+    def _priorities(self, pending, offsets, dependents):
+        """Returns, for every pending job, the estimated seconds from its
+        start until the end of the longest chain of pending jobs it heads.
+        A job is estimated to take as long as it did in the last build. Jobs
+        never built before are estimated from the size of their inputs, at
+        the seconds per byte the logged jobs took, or else at 1 MB/s.
+        Sequential builds need no priorities and get all zeros.
+        """
+        priority = array('d', [0.0]) * len(pending)
+        if self.jobs == 1:
+            return priority
+        durations = [self._log.duration(job.out) if self._log else None for job in pending]
+        sizes = {}
+
+        def size(job):
+            total = 0
+            for path in job.ins:
+                if path not in sizes:
+                    try:
+                        sizes[path] = os.path.getsize(path)
+                    except OSError:
+                        sizes[path] = 0
+                total += sizes[path]
+            return total
+
+        known = [i for i, duration in enumerate(durations) if duration is not None]
+        rate = 1e-6
+        if known and len(known) < len(pending):
+            known_bytes = sum(size(pending[i]) for i in known)
+            if known_bytes:
+                rate = sum(durations[i] for i in known) / known_bytes
+        # dependents come after the jobs they depend on
+        for i in range(len(pending) - 1, -1, -1):
+            estimate = durations[i] if durations[i] is not None else size(pending[i]) * rate
+            tail = max((priority[dependents[k]] for k in range(offsets[i], offsets[i + 1])), default=0.0)
+            priority[i] = estimate + tail
+        return priority
+
+    def critical_path(self):
+        """Returns the chain of jobs, from first to last, whose commands took
+        the longest time in total, as a list of (output, seconds) pairs.
+        """
+        # jobs are planned after their dependencies
+        longest = array('d')
+        best = array('l')
+        for job in self._planned:
+            dep = max(job.deps, key=longest.__getitem__, default=-1)
+            longest.append(job.duration + (longest[dep] if dep >= 0 else 0.0))
+            best.append(dep)
+        index = max(range(len(longest)), key=longest.__getitem__, default=-1)
+        path = []
+        while index >= 0:
+            job = self._planned[index]
+            if job.duration:
+                path.append((job.out, job.duration))
+            index = best[index]
+        return path[::-1]
+
+    def _report(self):
+        """Print the critical path and the slowest commands of the build."""
+        path = self.critical_path()
+        print("critical path: {} commands, {:.2f}s".format(len(path), sum(dur for _, dur in path)))
+        for out, duration in path:
+            print("  {:8.2f}s  {}".format(duration, out))
+        slowest = sorted(self._planned, key=lambda job: job.duration, reverse=True)
+        print("slowest commands:")
+        for job in slowest[:self._top]:
+            if job.duration:
+                print("  {:8.2f}s  {}".format(job.duration, job.out))
+
+
+# name -> Target or Dir, registered by snakefiles for the command line
+_TARGETS = {}
+
+
+def target(name, node):
+    """Register node (a Target or Dir) under name, for python -m snake name
+    to build. The first one registered is built by default. Returns node.
+    """
+    _TARGETS[name] = node
+    return node
+
+
+def build(*nodes, **options):
+    """Build several Targets or Dirs in one Session, so that whatever they
+    share is evaluated only once. Returns a list holding what each node's own
+    build() returns.
+    :param options: passed on to Session, e.g. jobs
+    """
+    return Session(**options).build(*nodes)
+
+
+def plan(*nodes, **options):
+    """Returns the commands building several Targets or Dirs in one Session
+    would run, without running any. See Session.plan().
+    :param options: passed on to Session
+    """
+    return Session(**options).plan(*nodes)
+
+
+def affected(changed, *nodes, **options):
+    """Returns the outputs of several Targets or Dirs that may need
+    rebuilding after the files changed were changed. See Session.affected().
+    :param options: passed on to Session
+    """
+    return Session(**options).affected(changed, *nodes)
+
+
+def watch(*nodes, interval=0.5, poll=False, rebuilds=None, **options):
+    """Build several Targets or Dirs, then rebuild them whenever their
+    sources change. See Session.watch().
+    :param options: passed on to Session, e.g. jobs
+    """
+    Session(**options).watch(*nodes, interval=interval, poll=poll, rebuilds=rebuilds)
+
+
+def _worker(argv):
+    """python -m snake worker: run a Worker."""
+    import argparse  # pylint: disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(prog='snake worker', description='Run the commands sent by RemoteExecutors.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--dir', help='where to keep inputs (default: a temporary directory)')
+    args = parser.parse_args(argv)
+
+    directory = args.dir or tempfile.mkdtemp(prefix='snake-worker-')
+    with Worker((args.host, args.port), directory) as server:
+        print("snake worker listening on {}:{}".format(*server.server_address[:2]), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def _cache_server(argv):
+    """python -m snake cache-server: run the reference HttpCache server."""
+    import argparse  # pylint: disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(prog='snake cache-server', description='Serve a shared artifact cache.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7778)
+    parser.add_argument('--dir', default=os.path.join(CACHE_DIR, 'server'), help='where to keep the entries')
+    args = parser.parse_args(argv)
+
+    with cache_server((args.host, args.port), args.dir) as server:
+        print("snake cache serving http://{}:{}".format(*server.server_address[:2]), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def _report_command(argv):
+    """python -m snake report: print the commands whose costs regressed."""
+    import argparse  # pylint: disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(prog='snake report', description='Report the outputs whose last build '
+                                     'cost more than threshold times the median of the builds before.')
+    parser.add_argument('-f', '--file', default='snakefile.py', help='the snakefile (default: snakefile.py)')
+    parser.add_argument('-t', '--threshold', type=float, default=1.5)
+    parser.add_argument('--json', action='store_true', help='print the whole history of costs instead')
+    args = parser.parse_args(argv)
+
+    log = BuildLog(os.path.join(os.path.dirname(os.path.realpath(args.file)), LOG_NAME))
+    if args.json:
+        print(json.dumps({out: [dict(zip(('time',) + log.COSTS, (when,) + costs)) for when, costs in history]
+                          for out, history in log.histories().items()}, indent=2))
+        return
+    regressions = log.regressions(args.threshold)
+    for out, cost, baseline, latest in regressions:
+        print("{}: {} {:.6g} -> {:.6g} ({:+.0%})".format(out, cost, baseline, latest, latest / baseline - 1))
+    if regressions:
+        sys.exit(1)
+
+
+def _affected(argv):
+    """python -m snake affected: print the targets downstream of changes."""
+    import argparse  # pylint: disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(prog='snake affected', description='Print the named targets that may need '
+                                     'rebuilding after the given files changed, e.g. git diff --name-only.')
+    parser.add_argument('paths', nargs='*', metavar='path', help='changed files (default: read from stdin)')
+    parser.add_argument('-f', '--file', default='snakefile.py', help='the snakefile (default: snakefile.py)')
+    parser.add_argument('--outputs', action='store_true', help='print the affected outputs instead')
+    args = parser.parse_args(argv)
+
+    session = _load(parser, args.file)
+    targets = session.load(os.path.realpath(args.file))
+    paths = args.paths or sys.stdin.read().split()
+    indices = session._affected([os.path.abspath(path) for path in paths])
+    if args.outputs:
+        print("\n".join(session._planned[index].out for index in indices))
+        return
+    indices = set(indices)
+    # a file added to or removed from a registered Dir affects it, even if no job is left reading its files
+    names = set(name for path in paths for name in session._dir_targets.get(os.path.dirname(os.path.abspath(path)), ()))
+    print("\n".join(name for name, roots in targets.items() if name in names or indices.intersection(roots)))
+
+
+def _load(parser, snakefile, **options):
+    """Returns a Session for the snakefile at path snakefile, with paths
+    made absolute relative to its directory.
+    """
+    global ABS_DIR_PATH  # pylint: disable=global-statement
+    if not os.path.isfile(snakefile):
+        parser.error('no snakefile {}'.format(snakefile))
+    ABS_DIR_PATH = os.path.dirname(os.path.realpath(snakefile))
+    return Session(**options)
+
+
+def main(argv=None):
+    """Command line entry point. python -m snake [target ...] builds the
+    named targets of snakefile.py in the working directory, python -m snake
+    affected lists those affected by changes to some files, python -m snake
+    report reports the commands whose costs regressed, python -m snake
+    worker runs a Worker and python -m snake cache-server an HttpCache.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['worker']:
+        _worker(argv[1:])
+        return
+    if argv[:1] == ['report']:
+        _report_command(argv[1:])
+        return
+    if argv[:1] == ['affected']:
+        _affected(argv[1:])
+        return
+    if argv[:1] == ['cache-server']:
+        _cache_server(argv[1:])
+        return
+    # imported here, as argparse takes about as long to import as snake
+    import argparse  # pylint: disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(prog='snake', description='Build the named targets of a snakefile.')
+    parser.add_argument('targets', nargs='*', metavar='target',
+                        help='targets to build (default: the first one registered)')
+    parser.add_argument('-f', '--file', default='snakefile.py', help='the snakefile (default: snakefile.py)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='commands to run at once')
+    parser.add_argument('-k', '--keep-going', action='store_true', help='build all that does not depend on a failure')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='print the commands a build would run')
+    parser.add_argument('-l', '--list', action='store_true', help='list the targets of the snakefile')
+    parser.add_argument('--restat', action='store_true', help='stop rebuilds at outputs that did not change')
+    parser.add_argument('--content', action='store_true', help='compare inputs by content, not by mtime')
+    parser.add_argument('--cache', help='artifact cache directory, or http(s):// URL of a shared one')
+    parser.add_argument('--cache-timeout', type=float, default=5.0,
+                        help='seconds to wait for a shared cache before building locally (default: 5)')
+    parser.add_argument('--trace', help='write a trace of the build to this file')
+    args = parser.parse_args(argv)
+    if args.cache and '://' in args.cache:
+        try:
+            args.cache = HttpCache(args.cache, args.cache_timeout)
+        except Exception as error:  # pylint: disable=broad-except
+            parser.error(str(error))
+
+    session = _load(parser, args.file, jobs=args.jobs, keep_going=args.keep_going, restat=args.restat,
+                    trace=args.trace, content=args.content, cache=args.cache)
+    targets = session.load(os.path.realpath(args.file))
+    if args.list:
+        print("\n".join(targets))
+        return
+    if not targets:
+        parser.error('{} registers no targets'.format(args.file))
+    for name in args.targets:
+        if name not in targets:
+            parser.error('no target {}, only {}'.format(name, ", ".join(targets)))
+    names = args.targets or [next(iter(targets))]
+    session._order = session._needed(index for name in names for index in targets[name])
+    try:
+        if args.dry_run:
+            for _, command, _ in session._steps():
+                print(" ".join(command))
+        else:
+            session._run()
+    except (Exception, KeyboardInterrupt) as error:  # pylint: disable=broad-except
+        sys.exit("snake: {}".format(error))
+
+
+if __name__ == '__main__':
+    # run main() in the snake module the snakefile imports, not in a copy
+    import snake
+    snake.main()
@@ -0,0 +1 @@
+#define SHARED 42
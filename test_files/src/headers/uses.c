@@ -0,0 +1,5 @@
+#include "shared.h"
+
+int uses(void) {
+    return SHARED;
+}
@@ -1,6 +1,17 @@
+import contextlib
+import io
+import json
 import unittest
-from snake import Target, Tool, Dir
+import snake
+from snake import (Target, Tool, Dir, ArtifactCache, HttpCache, BuildLog, LocalExecutor, RemoteExecutor, Session,
+                   affected, build, watch, parse_depfile)
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 
 TEST_FILES_DIR = 'test_files/'
@@ -80,6 +91,40 @@ class TestBasic(unittest.TestCase):
         self.assertTrue(os.path.isfile(out_file))
 
 
+class TestCommands(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def test_path_with_spaces(self):
+        out_file = TEST_FILES_DIR + 'obj/with space.c'
+        target = Target(out_file, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=Tool("cp {inp} {out}"))
+        target.build(log=False)
+        self.assertTrue(os.path.isfile(out_file))
+
+    def test_response_file(self):
+        out_file = TEST_FILES_DIR + 'bin/basic'
+        target = Target(out_file, deps=[TEST_FILES_DIR + 'src/basic.c', TEST_FILES_DIR + 'src/basic2.c'],
+                        tool=Tool("gcc {inp} -o {out}"))
+        arg_max = snake.ARG_MAX
+        snake.ARG_MAX = 0
+        try:
+            target.build(log=False)
+        finally:
+            snake.ARG_MAX = arg_max
+        self.assertTrue(os.path.isfile(out_file))
+        self.assertFalse(os.path.exists(out_file + '.rsp'))
+
+    def test_argv(self):
+        gcc = Tool("gcc -c {inp} -o {out} -MF {out}.d", flags=['-O2 -g'])
+        self.assertEqual(['gcc', '-c', 'a b.c', '-o', 'a.o', '-MF', 'a.o.d', '-O2', '-g'],
+                         gcc.argv(['a b.c'], ['a.o']))
+        self.assertEqual(['gcc', '-c', '@in.rsp', '-o', 'a.o', '-MF', 'a.o.d', '-O2', '-g'],
+                         gcc.argv(['a b.c'], ['a.o'], 'in.rsp'))
+
+
 class TestDirs(unittest.TestCase):
     def setUp(self):
         clean()
@@ -157,6 +202,99 @@ class TestDirs(unittest.TestCase):
         target.build()
         self.assertTrue(os.path.isfile(out_file))
 
+    def test_map_is_anchored(self):
+        dir3 = Dir(TEST_FILES_DIR + 'src/dir3', recursive=True)
+        # would match .../src/dir3/f1/a.c if searched anywhere in the path
+        dir3.map('f1/*.c', TEST_FILES_DIR + 'obj/dir3/f1/*.o')
+        dir3.map(TEST_FILES_DIR + 'src/dir3/f2/*.c', TEST_FILES_DIR + 'obj/dir3/f2/*.o')
+        dir3.map(TEST_FILES_DIR + 'src/dir3/f1/b.c', TEST_FILES_DIR + 'obj/dir3/f1/b.o')
+        outs = dir3.build(Tool("gcc -c {inp} -o {out}"))
+        self.assertEqual(4, len(outs))
+        self.assertTrue(os.path.isfile(TEST_FILES_DIR + 'obj/dir3/f2/a.o'))
+        self.assertTrue(os.path.isfile(TEST_FILES_DIR + 'obj/dir3/f1/b.o'))
+        self.assertFalse(os.path.exists(TEST_FILES_DIR + 'obj/dir3/f1/a.o'))
+        self.assertIn(os.path.abspath(TEST_FILES_DIR + 'src/dir3/f1/a.c'), outs)
+
+    def test_no_tool(self):
+        dir1 = Dir(TEST_FILES_DIR + 'src/dir1')
+        dir1.map(TEST_FILES_DIR + 'src/dir1/*.c', TEST_FILES_DIR + 'obj/dir1/*.o')
+        with self.assertRaisesRegex(Exception, 'no tool specified'):
+            dir1.build(log=False)
+        with self.assertRaisesRegex(Exception, 'no tool specified'):
+            dir1.plan(log=False)
+
+    def test_builds_while_scanning(self):
+        root = tempfile.mkdtemp()
+        try:
+            for i in range(4):
+                os.makedirs(os.path.join(root, 'src', 'd%d' % i))
+                os.makedirs(os.path.join(root, 'out', 'd%d' % i))
+                with open(os.path.join(root, 'src', 'd%d' % i, 'f.c'), 'w') as source:
+                    source.write('x\n')
+            built = []
+
+            class WaitingDir(Dir):
+                def _walk(self, threads=snake.WALK_THREADS):
+                    # hold the scan back until the files listed so far are built
+                    for listing in Dir._walk(self, threads):
+                        yield listing
+                        outs = [path.replace('/src/', '/out/')[:-2] + '.o' for path in listing[1]]
+                        deadline = time.time() + 5
+                        while not all(os.path.exists(out) for out in outs) and time.time() < deadline:
+                            time.sleep(0.01)
+                        built.append(all(os.path.exists(out) for out in outs))
+
+            files = WaitingDir(os.path.join(root, 'src'), recursive=True, tool=Tool("cp {inp} {out}"))
+            files.map(os.path.join(root, 'src', '*.c'), os.path.join(root, 'out', '*.o'))
+            outs = files.build(jobs=2, log=False)
+            self.assertEqual(5, len(built))
+            self.assertTrue(all(built))
+            expected = [path.replace('/src/', '/out/')[:-2] + '.o' for path in Dir._get_files(files)]
+            self.assertEqual(expected, outs)
+        finally:
+            shutil.rmtree(root)
+
+    def test_walk_order(self):
+        root = tempfile.mkdtemp()
+        try:
+            for sub in ('a', 'a/b', 'a/b/c', 'd', 'd/e'):
+                os.makedirs(os.path.join(root, sub))
+                with open(os.path.join(root, sub, 'f'), 'w'):
+                    pass
+            expected = []
+            for dirname, subdirs, names in os.walk(root):
+                subdirs[:] = [entry.name for entry in os.scandir(dirname) if entry.is_dir()]
+                expected += [os.path.join(dirname, name) for name in names]
+            self.assertEqual(expected, Dir(root, recursive=True)._get_files())
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_walk_skips_removed_subdir(self):
+        root = tempfile.mkdtemp()
+        try:
+            for sub in ('a', 'b'):
+                os.makedirs(os.path.join(root, sub))
+                with open(os.path.join(root, sub, 'f'), 'w'):
+                    pass
+
+            class RemovingDir(Dir):
+                def _walk(self, threads=snake.WALK_THREADS):
+                    # remove a subdirectory after its parent was listed
+                    for listing in Dir._walk(self, threads):
+                        yield listing
+                        if listing[0] == root:
+                            shutil.rmtree(os.path.join(root, 'a'))
+
+            files = RemovingDir(root, recursive=True)
+            self.assertEqual([os.path.join(root, 'b', 'f')], files._get_files())
+            # but not the Dir's own directory
+            shutil.rmtree(root)
+            with self.assertRaises(FileNotFoundError):
+                files._get_files()
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
 
 class TestUseCases(unittest.TestCase):
     def setUp(self):
@@ -256,6 +394,928 @@ class TestMemoization(unittest.TestCase):
         self.assertNotEqual(original_time_main, updated_time_main, "main executable wasn't rebuilt")
 
 
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def test_parallel_dir_and_link(self):
+        util_gcc = Tool("gcc -c {inp} -o {out}")
+        util = Dir(TEST_FILES_DIR + 'src/use_cases/util', tool=util_gcc)
+        util.map(TEST_FILES_DIR + 'src/use_cases/util/*.c', TEST_FILES_DIR + 'obj/use_cases/util/*.o')
+
+        main_out = TEST_FILES_DIR + 'bin/use_cases/main'
+        main_prog = Target(main_out, deps=[TEST_FILES_DIR + 'src/use_cases/main.c', util])
+        main_prog.build(Tool("gcc {inp} -o {out}"), jobs=4)
+        self.assertTrue(os.path.isfile(main_out))
+
+    def test_parallel_dir(self):
+        dir1 = Dir(TEST_FILES_DIR + 'src/dir1/', tool=Tool("gcc -c {inp} -o {out}"))
+        dir1.map(TEST_FILES_DIR + 'src/dir1/*.c', TEST_FILES_DIR + 'obj/dir1/*.o')
+        outs = dir1.build(jobs=3)
+        self.assertEqual(3, len(outs))
+        for out in outs:
+            self.assertTrue(os.path.isfile(out))
+
+    def test_failure_stops_build(self):
+        broken = Target(TEST_FILES_DIR + 'obj/broken.o', deps=[TEST_FILES_DIR + 'src/basic.c'],
+                        tool=Tool("false {inp} {out}"))
+        out_file = TEST_FILES_DIR + 'bin/basic'
+        target = Target(out_file, deps=[broken], tool=Tool("cp {inp} {out}"))
+        with self.assertRaises(subprocess.CalledProcessError):
+            target.build(jobs=2)
+        self.assertFalse(os.path.exists(out_file))
+
+    def test_keep_going(self):
+        false = Tool("false {inp} {out}")
+        cp = Tool("cp {inp} {out}")
+        broken = Target(TEST_FILES_DIR + 'obj/broken.o', deps=[TEST_FILES_DIR + 'src/basic.c'], tool=false)
+        also_broken = Target(TEST_FILES_DIR + 'obj/broken2.o', deps=[TEST_FILES_DIR + 'src/basic2.c'], tool=false)
+        downstream = Target(TEST_FILES_DIR + 'bin/downstream', deps=[broken], tool=cp)
+        fine = Target(TEST_FILES_DIR + 'bin/fine', deps=[TEST_FILES_DIR + 'src/basic.c'], tool=cp)
+        with self.assertRaises(Exception) as raised:
+            build(downstream, also_broken, fine, jobs=2, keep_going=True)
+        self.assertIn('2 commands failed', str(raised.exception))
+        self.assertIn('broken2.o', str(raised.exception))
+        self.assertTrue(os.path.isfile(TEST_FILES_DIR + 'bin/fine'))
+        self.assertFalse(os.path.exists(TEST_FILES_DIR + 'bin/downstream'))
+
+    def test_output_is_captured(self):
+        echo = Tool("echo {inp} {out}")
+        targets = [Target(TEST_FILES_DIR + 'obj/echo%d' % i, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=echo)
+                   for i in range(4)]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            build(*targets, jobs=4, log=False)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(4, len(lines))
+        for line in lines:
+            self.assertTrue(line.endswith(tuple('obj/echo%d' % i for i in range(4))))
+
+    def test_stderr_kept_apart(self):
+        target = Target(TEST_FILES_DIR + 'obj/listed', deps=[TEST_FILES_DIR + 'src/basic.c'],
+                        tool=Tool("ls {inp} {out}"))
+        with contextlib.redirect_stdout(io.StringIO()) as stdout, \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(subprocess.CalledProcessError):
+                target.build(log=False)
+        self.assertIn('src/basic.c', stdout.getvalue())
+        self.assertNotIn('obj/listed', stdout.getvalue())
+        self.assertIn('obj/listed', stderr.getvalue())
+
+    def test_pool_depth(self):
+        executor = CountingExecutor()
+        dir1 = Dir(TEST_FILES_DIR + 'src/dir1/', tool=Tool("cp {inp} {out}", pool='link', pool_depth=1))
+        dir1.map(TEST_FILES_DIR + 'src/dir1/*.c', TEST_FILES_DIR + 'obj/dir1/*.c')
+        dir1.build(jobs=3, executor=executor)
+        self.assertEqual(3, executor.calls)
+        self.assertEqual(1, executor.peak)
+
+    def test_pool_depths_must_agree(self):
+        first = Target(TEST_FILES_DIR + 'obj/a', deps=[TEST_FILES_DIR + 'src/basic.c'],
+                       tool=Tool("cp {inp} {out}", pool='link', pool_depth=1))
+        second = Target(TEST_FILES_DIR + 'obj/b', deps=[first], tool=Tool("cp {inp} {out}", pool='link', pool_depth=2))
+        with self.assertRaises(Exception):
+            second.build()
+
+    def test_longest_first(self):
+        seconds = {'a': 1.0, 'b': 5.0, 'c': 10.0}
+        serial = Tool("cp {inp} {out}", pool='serial', pool_depth=1)
+        targets = [Target(TEST_FILES_DIR + 'obj/' + name, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=serial)
+                   for name in sorted(seconds)]
+        executor = CountingExecutor()
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'log')
+            history = BuildLog(log)
+            for name, duration in seconds.items():
+                history.record_costs(os.path.abspath(TEST_FILES_DIR + 'obj/' + name), (duration, 0, 0, 0, 0, 0))
+            history.save()
+            Session(jobs=2, log=log, executor=executor).build(*targets)
+        self.assertEqual(['c', 'b', 'a'], [os.path.basename(args[-1]) for args in executor.commands])
+
+
+class CountingExecutor(LocalExecutor):
+    """Counts the commands run, and the most run at the same time."""
+
+    def __init__(self):
+        self.commands = []
+        self.calls = 0
+        self.peak = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def run(self, args, cwd=None, ins=(), outs=(), depfiles=()):
+        with self._lock:
+            self.calls += 1
+            self.commands.append(args)
+            self._running += 1
+            self.peak = max(self.peak, self._running)
+        try:
+            time.sleep(0.05)
+            return LocalExecutor.run(self, args, cwd, ins, outs, depfiles)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+
+class CountingDir(Dir):
+    scans = 0
+
+    def _get_files(self, stats=None):
+        CountingDir.scans += 1
+        return Dir._get_files(self, stats)
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        clean()
+        CountingDir.scans = 0
+
+    def tearDown(self):
+        clean()
+
+    def test_shared_dir_scanned_once(self):
+        util = CountingDir(TEST_FILES_DIR + 'src/use_cases/util', tool=Tool("gcc -c {inp} -o {out}"))
+        util.map(TEST_FILES_DIR + 'src/use_cases/util/*.c', TEST_FILES_DIR + 'obj/use_cases/util/*.o')
+
+        gcc = Tool("gcc {inp} -o {out}")
+        main_out = TEST_FILES_DIR + 'bin/use_cases/main'
+        main_prog = Target(main_out, deps=[TEST_FILES_DIR + 'src/use_cases/main.c', util], tool=gcc)
+        test_out = TEST_FILES_DIR + 'bin/use_cases/test'
+        test_prog = Target(test_out, deps=[TEST_FILES_DIR + 'src/use_cases/test.c', util], tool=gcc)
+
+        results = build(main_prog, test_prog, jobs=2)
+        self.assertEqual([os.path.abspath(main_out), os.path.abspath(test_out)], results)
+        self.assertEqual(1, CountingDir.scans)
+
+    def test_dependency_dir_listed_once(self):
+        listed = []
+
+        class ListingDir(Dir):
+            def _dirs(self):
+                listed.append(self.path)
+                return Dir._dirs(self)
+
+        dir3 = ListingDir(TEST_FILES_DIR + 'src/dir3', recursive=True)
+        headers = Dir(TEST_FILES_DIR + 'src/headers', tool=Tool("gcc -c {inp} -o {out}"), deps=[dir3])
+        headers.map(TEST_FILES_DIR + 'src/headers/*.c', TEST_FILES_DIR + 'obj/headers/*.o')
+        session = Session(log=False)
+        session.plan(headers)
+        self.assertEqual(1, len(listed))
+        outs = session.affected([TEST_FILES_DIR + 'src/dir3/f2/new.h'])
+        self.assertEqual(2, len(outs))
+
+    def test_affected(self):
+        util = Dir(TEST_FILES_DIR + 'src/use_cases/util', tool=Tool("gcc -c {inp} -o {out}"))
+        util.map(TEST_FILES_DIR + 'src/use_cases/util/*.c', TEST_FILES_DIR + 'obj/use_cases/util/*.o')
+        gcc = Tool("gcc {inp} -o {out}")
+        main_prog = Target(TEST_FILES_DIR + 'bin/use_cases/main',
+                           deps=[TEST_FILES_DIR + 'src/use_cases/main.c', util], tool=gcc)
+        test_prog = Target(TEST_FILES_DIR + 'bin/use_cases/test',
+                           deps=[TEST_FILES_DIR + 'src/use_cases/test.c', util], tool=gcc)
+
+        def names(changed):
+            return [os.path.basename(out) for out in affected(changed, main_prog, test_prog, log=False)]
+        self.assertEqual(['main'], names([TEST_FILES_DIR + 'src/use_cases/main.c']))
+        self.assertEqual(['utility.o', 'main', 'test'], names([TEST_FILES_DIR + 'src/use_cases/util/utility.c']))
+        # a file added to or removed from the Dir
+        self.assertEqual(['main', 'test'], names([TEST_FILES_DIR + 'src/use_cases/util/new.c']))
+        self.assertEqual([], names([TEST_FILES_DIR + 'src/basic.c']))
+
+    def test_diamond(self):
+        cp = Tool("cp {inp} {out}")
+        bottom = Target(TEST_FILES_DIR + 'obj/bottom', deps=[TEST_FILES_DIR + 'src/basic.c'], tool=cp)
+        top = bottom
+        for i in range(30):
+            left = Target(TEST_FILES_DIR + 'obj/left%d' % i, deps=[top], tool=cp)
+            right = Target(TEST_FILES_DIR + 'obj/right%d' % i, deps=[top], tool=Tool("touch {out} {inp}"))
+            top = Target(TEST_FILES_DIR + 'obj/top%d' % i, deps=[left, right], tool=Tool("touch {out} {inp}"))
+        top.build()
+        self.assertTrue(os.path.isfile(TEST_FILES_DIR + 'obj/top29'))
+
+    def test_stat_cache(self):
+        dir1 = Dir(TEST_FILES_DIR + 'src/dir1/', tool=Tool("gcc -c {inp} -o {out}"))
+        dir1.map(TEST_FILES_DIR + 'src/dir1/*.c', TEST_FILES_DIR + 'obj/dir1/*.o')
+        link = Target(TEST_FILES_DIR + 'obj/dir1.tar', deps=[dir1], tool=Tool("tar cf {out} {inp}"))
+        first = Session()
+        first.build(link, dir1)
+        self.assertTrue(os.path.isfile(TEST_FILES_DIR + 'obj/dir1.tar'))
+
+        second = Session()
+        second.build(link, dir1)
+        # the .o files are stat'ed by both dir1's and link's checks
+        self.assertGreaterEqual(second.stats.saved, 3)
+
+
+class TestBuildLog(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def test_flag_change_rebuilds(self):
+        out_file = TEST_FILES_DIR + 'obj/basic.o'
+        my_tool = Tool("gcc -c {inp} -o {out}", flags=['-O0'])
+        target = Target(out_file, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=my_tool)
+        target.build()
+        first = os.stat(out_file).st_mtime_ns
+        target.build()
+        self.assertEqual(first, os.stat(out_file).st_mtime_ns, "file was rebuilt")
+
+        target.tool(Tool("gcc -c {inp} -o {out}", flags=['-O2']))
+        target.build()
+        self.assertNotEqual(first, os.stat(out_file).st_mtime_ns, "flag change didn't rebuild")
+
+    def test_older_input_rebuilds(self):
+        in_file = TEST_FILES_DIR + 'src/basic.c'
+        out_file = TEST_FILES_DIR + 'obj/basic.c'
+        target = Target(out_file, deps=[in_file], tool=Tool("cp {inp} {out}"))
+        target.build()
+        first = os.stat(out_file).st_mtime_ns
+
+        # an input restored to an older mtime is still a change
+        stat = os.stat(in_file)
+        os.utime(in_file, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 9))
+        try:
+            target.build()
+        finally:
+            os.utime(in_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertNotEqual(first, os.stat(out_file).st_mtime_ns, "changed input didn't rebuild")
+
+    def test_restat_cuts_off_identical_output(self):
+        in_file = TEST_FILES_DIR + 'src/basic.c'
+        generated = TEST_FILES_DIR + 'obj/gen.c'
+        out_file = TEST_FILES_DIR + 'obj/gen.o'
+        gen = Target(generated, deps=[in_file], tool=Tool("cp {inp} {out}"))
+        target = Target(out_file, deps=[gen], tool=Tool("gcc -c {inp} -o {out}"))
+        target.build(restat=True)
+        first = os.stat(out_file).st_mtime_ns
+
+        stat = os.stat(in_file)
+        os.utime(in_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        try:
+            session = Session(restat=True)
+            session.build(target)
+        finally:
+            os.utime(in_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(1, session.cutoffs)
+        self.assertEqual(first, os.stat(out_file).st_mtime_ns, "unchanged output rebuilt its dependent")
+
+    def test_content_staleness(self):
+        in_file = TEST_FILES_DIR + 'obj/in.c'
+        out_file = TEST_FILES_DIR + 'obj/out.c'
+        with open(in_file, 'w') as source:
+            source.write('one\n')
+        past = time.time() - 100
+        os.utime(in_file, (past, past))
+        target = Target(out_file, deps=[in_file], tool=Tool("cp {inp} {out}"))
+        target.build(content=True)
+        first = os.stat(out_file).st_mtime_ns
+
+        # touched, but with the same contents
+        os.utime(in_file, (past + 10, past + 10))
+        session = Session(content=True)
+        session.build(target)
+        self.assertEqual(first, os.stat(out_file).st_mtime_ns, "touched input rebuilt its output")
+        self.assertEqual(1, session._hashes.hashed)
+
+        # changed, but with the same mtime
+        with open(in_file, 'w') as source:
+            source.write('two\n')
+        os.utime(in_file, (past + 10, past + 10))
+        target.build(content=True)
+        with open(out_file) as out:
+            self.assertEqual('two\n', out.read())
+
+    def test_prefetch_pool(self):
+        hashes = snake.HashCache()
+        hashes.prefetch([TEST_FILES_DIR + 'src/basic.c'], threads=2)
+        workers = list(hashes._workers)
+        # later calls, e.g. one per listing of a Dir being scanned, reuse the threads
+        hashes.prefetch([TEST_FILES_DIR + 'src/basic2.c', TEST_FILES_DIR + 'src/missing.c'], threads=2)
+        self.assertEqual(workers, hashes._workers)
+        self.assertEqual(2, hashes.hashed)
+        hashes.close()
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+    def test_costs_history(self):
+        out_file = TEST_FILES_DIR + 'obj/basic.o'
+        target = Target(out_file, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=Tool("gcc -c {inp} -o {out}"))
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'log')
+            target.build(log=log)
+            history = BuildLog(log).history(os.path.abspath(out_file))
+            self.assertEqual({os.path.abspath(out_file): history}, BuildLog(log).histories())
+        self.assertEqual(1, len(history))
+        costs = dict(zip(BuildLog.COSTS, history[0][1]))
+        self.assertGreater(costs['seconds'], 0)
+        self.assertGreater(costs['maxrss'], 0)
+
+    def test_regressions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = BuildLog(os.path.join(tmp, 'log'))
+            for seconds, rss in ((1.0, 100), (1.2, 110), (0.9, 90), (1.1, 400)):
+                log.record_costs('slow', (seconds, seconds, 0, rss, 0, 0))
+                log.record_costs('steady', (seconds, seconds, 0, 100, 0, 0))
+            log.record_costs('slow', (3.0, 3.0, 0, 100, 0, 0))
+            self.assertEqual([('slow', 'seconds', 1.1, 3.0), ('slow', 'user', 1.1, 3.0)], log.regressions(2))
+            for _ in range(BuildLog.HISTORY):
+                log.record_costs('slow', (1.0, 1.0, 0, 100, 0, 0))
+            self.assertEqual(BuildLog.HISTORY, len(log.history('slow')))
+
+
+class TestDepfiles(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def test_header_change_rebuilds_includers_only(self):
+        header = TEST_FILES_DIR + 'src/headers/shared.h'
+        uses_out = TEST_FILES_DIR + 'obj/headers/uses.o'
+        other_out = TEST_FILES_DIR + 'obj/headers/other.o'
+        gcc = Tool("gcc -c {inp} -o {out} -MMD -MF {out}.d", depfile='{out}.d')
+        headers = Dir(TEST_FILES_DIR + 'src/headers', tool=gcc)
+        headers.map(TEST_FILES_DIR + 'src/headers/*.c', TEST_FILES_DIR + 'obj/headers/*.o')
+        headers.build()
+        uses_time = os.stat(uses_out).st_mtime_ns
+        other_time = os.stat(other_out).st_mtime_ns
+
+        stat = os.stat(header)
+        os.utime(header, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        try:
+            headers.build()
+        finally:
+            os.utime(header, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertNotEqual(uses_time, os.stat(uses_out).st_mtime_ns, "includer wasn't rebuilt")
+        self.assertEqual(other_time, os.stat(other_out).st_mtime_ns, "non-includer was rebuilt")
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def test_batched_dir(self):
+        dir1 = Dir(TEST_FILES_DIR + 'src/dir1/', tool=Tool("gcc -c {inp}", batch=2))
+        dir1.map(TEST_FILES_DIR + 'src/dir1/*.c', TEST_FILES_DIR + 'obj/dir1/*.o')
+        outs = dir1.build(jobs=2)
+        times = {}
+        for out in outs:
+            self.assertTrue(os.path.isfile(out))
+            times[out] = os.stat(out).st_mtime_ns
+
+        source = TEST_FILES_DIR + 'src/dir1/b.c'
+        stat = os.stat(source)
+        os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        try:
+            dir1.build()
+        finally:
+            os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        for out in outs:
+            if out.endswith('b.o'):
+                self.assertNotEqual(times[out], os.stat(out).st_mtime_ns, "stale output wasn't rebuilt")
+            else:
+                self.assertEqual(times[out], os.stat(out).st_mtime_ns, "up to date output was rebuilt")
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def test_trace(self):
+        trace = TEST_FILES_DIR + 'obj/trace.json'
+        util = Dir(TEST_FILES_DIR + 'src/use_cases/util', tool=Tool("gcc -c {inp} -o {out}"))
+        util.map(TEST_FILES_DIR + 'src/use_cases/util/*.c', TEST_FILES_DIR + 'obj/use_cases/util/*.o')
+        main_out = TEST_FILES_DIR + 'bin/use_cases/main'
+        main_prog = Target(main_out, deps=[TEST_FILES_DIR + 'src/use_cases/main.c', util],
+                           tool=Tool("gcc {inp} -o {out}"))
+        session = Session(trace=trace)
+        session.build(main_prog)
+
+        with open(trace) as events:
+            cats = [event['cat'] for event in json.load(events)['traceEvents']]
+        self.assertEqual(1, cats.count('scan'))
+        self.assertEqual(2, cats.count('check'))
+        self.assertEqual(2, cats.count('run'))
+        path = [out for out, _ in session.critical_path()]
+        self.assertEqual([os.path.abspath(TEST_FILES_DIR + 'obj/use_cases/util/utility.o'),
+                          os.path.abspath(main_out)], path)
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def test_plan(self):
+        util_gcc = Tool("gcc -c {inp} -o {out}")
+        util = Dir(TEST_FILES_DIR + 'src/use_cases/util', tool=util_gcc)
+        util.map(TEST_FILES_DIR + 'src/use_cases/util/*.c', TEST_FILES_DIR + 'obj/use_cases/util/*.o')
+        util_out = os.path.abspath(TEST_FILES_DIR + 'obj/use_cases/util/utility.o')
+        main_out = os.path.abspath(TEST_FILES_DIR + 'bin/use_cases/main')
+        main_prog = Target(main_out, deps=[TEST_FILES_DIR + 'src/use_cases/main.c', util],
+                           tool=Tool("gcc {inp} -o {out}"))
+
+        steps = main_prog.plan()
+        self.assertEqual([(util_out, 'missing output'), (main_out, 'rebuilt dependency ' + util_out)],
+                         [(out, reason) for out, _, reason in steps])
+        self.assertEqual('gcc', steps[0][1][0])
+        self.assertFalse(os.path.exists(util_out))
+
+        main_prog.build()
+        self.assertEqual([], main_prog.plan())
+
+        util_gcc.flags('-O2')
+        self.assertEqual([(util_out, 'changed command'), (main_out, 'rebuilt dependency ' + util_out)],
+                         [(out, reason) for out, _, reason in main_prog.plan()])
+
+    def test_long_chain(self):
+        copy = Tool("cp {inp} {out}")
+        target = TEST_FILES_DIR + 'src/basic.c'
+        for i in range(5000):
+            target = Target(TEST_FILES_DIR + 'obj/t%d' % i, deps=[target], tool=copy)
+        steps = target.plan(log=False)
+        self.assertEqual(5000, len(steps))
+        self.assertEqual(os.path.abspath(TEST_FILES_DIR + 'obj/t0'), steps[0][0])
+
+    def test_cycle(self):
+        copy = Tool("cp {inp} {out}")
+        first = Target(TEST_FILES_DIR + 'obj/first', tool=copy)
+        second = Target(TEST_FILES_DIR + 'obj/second', deps=[first], tool=copy)
+        first.depends_on(second)
+        with self.assertRaisesRegex(Exception, 'dependency cycle'):
+            first.plan(log=False)
+
+    def test_cycle_through_output(self):
+        copy = Tool("cp {inp} {out}")
+        inner = Target(TEST_FILES_DIR + 'obj/first', deps=[TEST_FILES_DIR + 'src/basic.c'], tool=copy)
+        middle = Target(TEST_FILES_DIR + 'obj/second', deps=[inner], tool=copy)
+        # a different Target building the same output as inner
+        outer = Target(TEST_FILES_DIR + 'obj/first', deps=[middle], tool=copy)
+        with self.assertRaisesRegex(Exception, 'dependency cycle through .*first'):
+            outer.plan(log=False)
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        clean()
+
+    def tearDown(self):
+        clean()
+
+    def watch_and_touch(self, poll):
+        source = TEST_FILES_DIR + 'src/basic.c'
+        out_file = TEST_FILES_DIR + 'obj/basic.o'
+        other_out = TEST_FILES_DIR + 'obj/basic2.o'
+        gcc = Tool("gcc -c {inp} -o {out}")
+        target = Target(out_file, deps=[source], tool=gcc)
+        other = Target(other_out, deps=[TEST_FILES_DIR + 'src/basic2.c'], tool=gcc)
+        # watch() reports a failed build and keeps waiting, so it runs as a
+        # daemon and the test gives up as soon as it reports one
+        watcher = threading.Thread(target=watch, args=(target, other), daemon=True,
+                                   kwargs={'interval': 0.05, 'poll': poll, 'rebuilds': 1})
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            watcher.start()
+            for _ in range(100):
+                if os.path.exists(out_file) and os.path.exists(other_out) or 'build failed' in output.getvalue():
+                    break
+                time.sleep(0.05)
+            self.assertNotIn('build failed', output.getvalue())
+            # let the first build finish writing both outputs
+            time.sleep(0.2)
+            first = os.stat(out_file).st_mtime_ns
+            other_time = os.stat(other_out).st_mtime_ns
+
+            stat = os.stat(source)
+            os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            try:
+                watcher.join(10)
+            finally:
+                os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertNotIn('build failed', output.getvalue())
+        self.assertFalse(watcher.is_alive())
+        self.assertNotEqual(first, os.stat(out_file).st_mtime_ns, "changed source wasn't rebuilt")
+        self.assertEqual(other_time, os.stat(other_out).st_mtime_ns, "unchanged source was rebuilt")
+
+    def test_watch_poll(self):
+        self.watch_and_touch(True)
+
+    def test_watch(self):
+        self.watch_and_touch(False)
+
+    def watch_header(self, poll):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'src'))
+            os.makedirs(os.path.join(root, 'inc'))
+            source = os.path.join(root, 'src', 'main.c')
+            header = os.path.join(root, 'inc', 'main.h')
+            out_file = os.path.join(root, 'main.o')
+            with open(source, 'w') as src:
+                src.write('#include "main.h"\nint main(void) { return VALUE; }\n')
+            with open(header, 'w') as inc:
+                inc.write('#define VALUE 0\n')
+            gcc = Tool("gcc -c {inp} -o {out} -I " + os.path.join(root, 'inc') + " -MMD -MF {out}.d",
+                       depfile='{out}.d')
+            target = Target(out_file, deps=[source], tool=gcc)
+            # the header is only known from the depfile of the first build
+            watcher = threading.Thread(target=watch, args=(target,), daemon=True,
+                                       kwargs={'interval': 0.05, 'poll': poll, 'rebuilds': 1, 'log': False})
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                watcher.start()
+                for _ in range(100):
+                    if os.path.exists(out_file + '.d') or 'build failed' in output.getvalue():
+                        break
+                    time.sleep(0.05)
+                self.assertNotIn('build failed', output.getvalue())
+                time.sleep(0.2)
+                first = os.stat(out_file).st_mtime_ns
+
+                stat = os.stat(header)
+                os.utime(header, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+                watcher.join(10)
+            self.assertNotIn('build failed', output.getvalue())
+            self.assertFalse(watcher.is_alive(), "changed header wasn't noticed")
+            self.assertNotEqual(first, os.stat(out_file).st_mtime_ns, "changed header wasn't rebuilt")
+
+    def test_watch_header_poll(self):
+        self.watch_header(True)
+
+    def test_watch_header(self):
+        self.watch_header(False)
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        clean()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        clean()
+        shutil.rmtree(self.cache_dir)
+
+    def test_restore_after_clean(self):
+        out_file = TEST_FILES_DIR + 'obj/basic.o'
+        target = Target(out_file, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=Tool("gcc -c {inp} -o {out}"))
+        cache = ArtifactCache(self.cache_dir)
+        target.build(cache=cache)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        with open(out_file, 'rb') as built:
+            content = built.read()
+
+        clean()
+        target.build(cache=cache)
+        self.assertEqual(1, cache.hits)
+        with open(out_file, 'rb') as restored:
+            self.assertEqual(content, restored.read())
+
+    def test_rebuild_without_cache_keeps_entry(self):
+        with tempfile.TemporaryDirectory() as root:
+            inp = os.path.join(root, 'in')
+            out_file = os.path.join(root, 'out')
+            target = Target(out_file, deps=[inp], tool=Tool("cp {inp} {out}"))
+            with open(inp, 'w') as source:
+                source.write('v1')
+            target.build(log=False, cache=self.cache_dir)
+            os.remove(out_file)
+            target.build(log=False, cache=self.cache_dir)
+
+            # the restored output is rewritten in place by a build not using the cache
+            with open(inp, 'w') as source:
+                source.write('v2')
+            target.build(log=False)
+            with open(inp, 'w') as source:
+                source.write('v1')
+            os.remove(out_file)
+            cache = ArtifactCache(self.cache_dir)
+            target.build(log=False, cache=cache)
+            self.assertEqual(1, cache.hits)
+            with open(out_file) as restored:
+                self.assertEqual('v1', restored.read())
+
+    def test_shared_between_roots(self):
+        abs_dir_path = snake.ABS_DIR_PATH
+        hits = []
+        try:
+            with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+                for root in (first, second):
+                    snake.ABS_DIR_PATH = root = os.path.realpath(root)
+                    os.makedirs(os.path.join(root, 'inc'))
+                    with open(os.path.join(root, 'main.c'), 'w') as source:
+                        source.write('#include "main.h"\nint value = VALUE;\n')
+                    with open(os.path.join(root, 'inc', 'main.h'), 'w') as header:
+                        header.write('#define VALUE 1\n')
+                    gcc = Tool("gcc -c {inp} -o {out} -I " + os.path.join(root, 'inc') + " -MMD -MF {out}.d",
+                               depfile='{out}.d')
+                    target = Target(os.path.join(root, 'main.o'), deps=[os.path.join(root, 'main.c')], tool=gcc)
+                    cache = ArtifactCache(self.cache_dir)
+                    target.build(log=False, cache=cache)
+                    hits.append(cache.hits)
+
+                # the manifest names the header of the checkout fetching from it
+                with open(os.path.join(second, 'inc', 'main.h'), 'w') as header:
+                    header.write('#define VALUE 2\n')
+                os.remove(os.path.join(second, 'main.o'))
+                cache = ArtifactCache(self.cache_dir)
+                target.build(log=False, cache=cache)
+                hits.append(cache.hits)
+        finally:
+            snake.ABS_DIR_PATH = abs_dir_path
+        self.assertEqual([0, 1, 0], hits)
+
+    def test_eviction(self):
+        cache = ArtifactCache(self.cache_dir, max_size=2000)
+        for i in range(5):
+            out_file = TEST_FILES_DIR + 'obj/blob%d' % i
+            with open(out_file, 'wb') as blob:
+                blob.write(b'x' * 1000)
+            cache.store(ArtifactCache.key([str(i)], []), out_file)
+        sizes = [os.path.getsize(os.path.join(root, name))
+                 for root, _, files in os.walk(self.cache_dir) for name in files]
+        self.assertLessEqual(sum(sizes), 2000)
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        clean()
+        self.cache_dir = tempfile.mkdtemp()
+        self.server = subprocess.Popen([sys.executable, 'snake.py', 'cache-server', '--port', '0',
+                                        '--dir', self.cache_dir], stdout=subprocess.PIPE)
+        self.url = self.server.stdout.readline().decode().split()[-1]
+
+    def tearDown(self):
+        clean()
+        self.server.kill()
+        self.server.wait()
+        self.server.stdout.close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_restore_after_clean(self):
+        out_file = TEST_FILES_DIR + 'obj/basic.o'
+        target = Target(out_file, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=Tool("gcc -c {inp} -o {out}"))
+        cache = HttpCache(self.url)
+        target.build(cache=cache)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        with open(out_file, 'rb') as built:
+            content = built.read()
+
+        clean()
+        target.build(cache=HttpCache(self.url))
+        with open(out_file, 'rb') as restored:
+            self.assertEqual(content, restored.read())
+        self.assertFalse(cache.down)
+
+    def test_implicit_dependencies(self):
+        gcc = Tool("gcc -c {inp} -o {out} -MMD -MF {out}.d", depfile='{out}.d')
+        target = Target(TEST_FILES_DIR + 'obj/headers/uses.o', deps=[TEST_FILES_DIR + 'src/headers/uses.c'], tool=gcc)
+        target.build(cache=self.url)
+        clean()
+        cache = HttpCache(self.url)
+        target.build(cache=cache)
+        self.assertEqual(1, cache.hits)
+
+    def test_urls(self):
+        cache = HttpCache('https://cache.example.com/snake')
+        self.assertEqual((True, 'cache.example.com', 443, '/snake/'),
+                         (cache.secure, cache.host, cache.port, cache.prefix))
+        self.assertIsInstance(Session(log=False, cache='https://cache.example.com/snake')._cache, HttpCache)
+        with self.assertRaisesRegex(Exception, 'http:// or https://'):
+            Session(log=False, cache='ftp://cache.example.com/snake')
+        self.assertFalse(os.path.exists('ftp:'))
+
+    def test_unreachable(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        out_file = TEST_FILES_DIR + 'obj/basic.o'
+        target = Target(out_file, deps=[TEST_FILES_DIR + 'src/basic.c'], tool=Tool("gcc -c {inp} -o {out}"))
+        cache = HttpCache('http://127.0.0.1:{}/'.format(port), timeout=1)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            target.build(log=False, cache=cache)
+        self.assertTrue(os.path.isfile(out_file))
+        self.assertTrue(cache.down)
+        self.assertEqual(1, output.getvalue().count('unreachable'))
+
+
+class TestRemote(unittest.TestCase):
+    def setUp(self):
+        clean()
+        self.worker_dir = tempfile.mkdtemp()
+        self.worker = subprocess.Popen([sys.executable, 'snake.py', 'worker', '--port', '0',
+                                        '--dir', self.worker_dir], stdout=subprocess.PIPE)
+        self.address = self.worker.stdout.readline().decode().split()[-1]
+
+    def tearDown(self):
+        clean()
+        self.worker.kill()
+        self.worker.wait()
+        self.worker.stdout.close()
+        shutil.rmtree(self.worker_dir)
+
+    def test_build_on_worker(self):
+        gcc = Tool("gcc -c {inp} -o {out} -MMD -MF {out}.d", depfile='{out}.d')
+        headers = Dir(TEST_FILES_DIR + 'src/headers', tool=gcc)
+        headers.map(TEST_FILES_DIR + 'src/headers/*.c', TEST_FILES_DIR + 'obj/headers/*.o')
+        executor = RemoteExecutor([self.address], connections=2, shared=[TEST_FILES_DIR + 'src/headers'])
+        outs = [out for out in headers.build(jobs=2, log=False, executor=executor) if out.endswith('.o')]
+        self.assertEqual(2, len(outs))
+        for out in outs:
+            self.assertTrue(os.path.isfile(out))
+        deps = parse_depfile(TEST_FILES_DIR + 'obj/headers/uses.o.d')
+        self.assertIn(os.path.abspath(TEST_FILES_DIR + 'src/headers/shared.h'), deps)
+
+    def test_worker_restart(self):
+        copy = Tool("cp {inp} {out}")
+        executor = RemoteExecutor([self.address])
+        Target(TEST_FILES_DIR + 'obj/first', deps=[TEST_FILES_DIR + 'src/basic.c'], tool=copy).build(
+            log=False, executor=executor)
+        # the pooled connection goes stale when the worker is restarted
+        self.worker.kill()
+        self.worker.wait()
+        self.worker.stdout.close()
+        port = self.address.rpartition(':')[2]
+        self.worker = subprocess.Popen([sys.executable, 'snake.py', 'worker', '--port', port,
+                                        '--dir', self.worker_dir], stdout=subprocess.PIPE)
+        self.worker.stdout.readline()
+        for name in ('second', 'third'):
+            out_file = Target(TEST_FILES_DIR + 'obj/' + name, deps=[TEST_FILES_DIR + 'src/basic.c'],
+                              tool=copy).build(log=False, executor=executor)
+            self.assertTrue(os.path.isfile(out_file))
+
+    def test_relocate(self):
+        self.assertEqual('-I/scratch/a /scratch /root/package2/b',
+                         snake._relocate('-I/root/package/a /root/package /root/package2/b', '/root/package',
+                                         '/scratch'))
+        self.assertEqual(b'/scratch/a.o: /root/package2/a.h\n',
+                         snake._relocate(b'/root/package/a.o: /root/package2/a.h\n', '/root/package', '/scratch'))
+
+    def test_stderr_kept_apart(self):
+        target = Target(TEST_FILES_DIR + 'obj/listed', deps=[TEST_FILES_DIR + 'src/basic.c'],
+                        tool=Tool("ls {inp} {out}"))
+        with contextlib.redirect_stdout(io.StringIO()) as stdout, \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(subprocess.CalledProcessError):
+                target.build(log=False, executor=RemoteExecutor([self.address]))
+        self.assertIn('src/basic.c', stdout.getvalue())
+        self.assertIn('obj/listed', stderr.getvalue())
+
+    def test_failure(self):
+        target = Target(TEST_FILES_DIR + 'obj/missing.o', deps=[TEST_FILES_DIR + 'src/basic.c'],
+                        tool=Tool("false {inp} {out}"))
+        with self.assertRaises(subprocess.CalledProcessError):
+            target.build(log=False, executor=RemoteExecutor([self.address]))
+
+
+class TestCommandLine(unittest.TestCase):
+    SNAKEFILE = """
+from snake import Dir, Target, Tool, target
+print("evaluated")
+src = Dir('src', tool=Tool("cp {inp} {out}"))
+src.map('src/*.c', 'out/*.o')
+target('all', Target('out/all', deps=[src], tool=Tool("sort -o {out} {inp}")))
+target('objs', src)
+"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for dirname in ('src', 'out'):
+            os.makedirs(os.path.join(self.root, dirname))
+        for name in ('a.c', 'b.c'):
+            with open(os.path.join(self.root, 'src', name), 'w') as source:
+                source.write(name + '\n')
+        with open(os.path.join(self.root, 'snakefile.py'), 'w') as snakefile:
+            snakefile.write(self.SNAKEFILE)
+        # directories changed within the last second are not cached
+        for dirname in ('src', 'out', ''):
+            os.utime(os.path.join(self.root, dirname), (time.time() - 10, time.time() - 10))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def snake(self, *args):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run([sys.executable, '-m', 'snake'] + list(args), cwd=self.root, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_build_named_targets(self):
+        self.assertEqual(['all', 'objs'], self.snake('-l').stdout.split()[1:])
+        result = self.snake('objs')
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'out', 'a.o')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'out', 'all')))
+
+        # the graph is cached, so the snakefile is not evaluated again
+        result = self.snake('-j', '2')
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertNotIn('evaluated', result.stdout)
+        with open(os.path.join(self.root, 'out', 'all')) as out:
+            self.assertEqual('a.c\nb.c\n', out.read())
+
+    def test_new_file_invalidates_graph(self):
+        self.snake()
+        with open(os.path.join(self.root, 'src', 'c.c'), 'w') as source:
+            source.write('c.c\n')
+        result = self.snake('-n')
+        self.assertIn('evaluated', result.stdout)
+        self.assertIn('c.c', result.stdout)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'out', 'c.o')))
+
+    def test_copied_tree_invalidates_graph(self):
+        self.snake('-n')
+        original, copy = self.root, tempfile.mkdtemp()
+        try:
+            # copytree() keeps the mtimes, so only the location tells the trees apart
+            self.root = os.path.join(copy, 'tree')
+            shutil.copytree(original, self.root, symlinks=True)
+            result = self.snake('-n')
+            self.assertIn('evaluated', result.stdout)
+            self.assertIn(os.path.realpath(self.root), result.stdout)
+        finally:
+            self.root = original
+            shutil.rmtree(copy)
+
+    def test_imported_module_invalidates_graph(self):
+        with open(os.path.join(self.root, 'rules.py'), 'w') as module:
+            module.write('COMMAND = "cp {inp} {out}"\n')
+        with open(os.path.join(self.root, 'snakefile.py'), 'w') as snakefile:
+            snakefile.write('import rules\n' + self.SNAKEFILE.replace('"cp {inp} {out}"', 'rules.COMMAND'))
+        os.utime(self.root, (time.time() - 10, time.time() - 10))
+        self.snake('-n')
+        past = time.time() - 5
+        with open(os.path.join(self.root, 'rules.py'), 'w') as module:
+            module.write('COMMAND = "ln {inp} {out}"\n')
+        os.utime(os.path.join(self.root, 'rules.py'), (past, past))
+        result = self.snake('-n')
+        self.assertIn('evaluated', result.stdout)
+        self.assertIn('ln ', result.stdout)
+
+    def test_report(self):
+        self.snake()
+        result = self.snake('report', '--json')
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertIn(os.path.join(os.path.realpath(self.root), 'out', 'a.o'), json.loads(result.stdout))
+
+    def test_affected(self):
+        self.snake('-n')
+        result = self.snake('affected', 'src/b.c')
+        self.assertEqual(['all', 'objs'], result.stdout.split())
+        result = self.snake('affected', '--outputs', 'out/b.o')
+        self.assertEqual([os.path.join(os.path.realpath(self.root), 'out', 'all')], result.stdout.split())
+
+    def test_affected_by_removed_file(self):
+        self.snake('-n')
+        os.remove(os.path.join(self.root, 'src', 'a.c'))
+        # no job reads src/a.c any more, but the Dir registered as objs scanned it
+        result = self.snake('affected', 'src/a.c')
+        self.assertEqual(['evaluated', 'all', 'objs'], result.stdout.split())
+
+    def test_shared_cache(self):
+        # a non-routable address: connecting times out after --cache-timeout
+        start = time.time()
+        result = self.snake('--cache', 'http://10.255.255.1:7778/', '--cache-timeout', '0.5')
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertIn('unreachable', result.stdout)
+        self.assertLess(time.time() - start, 4)
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'out', 'all')))
+        result = self.snake('--cache', 'ftp://cache.example.com/')
+        self.assertNotEqual(0, result.returncode)
+        self.assertIn('http:// or https://', result.stderr)
+
+    def test_unknown_target(self):
+        result = self.snake('nonesuch')
+        self.assertNotEqual(0, result.returncode)
+        self.assertIn('no target nonesuch', result.stderr)
+
+
+class TestBench(unittest.TestCase):
+    def test_bench_runs(self):
+        output = subprocess.check_output([sys.executable, 'bench.py', '--scale', '0.001', '--jobs', '2'])
+        results = json.loads(output.decode())['results']
+        self.assertEqual(['deep', 'diamond', 'maps', 'wide'], [res['scenario'] for res in results])
+        for res in results:
+            self.assertGreater(res['full'], 0)
+
+    def test_deep_chain(self):
+        # planning and building a chain of thousands of Targets must not recurse
+        output = subprocess.check_output([sys.executable, 'bench.py', 'deep', '--scale', '3'])
+        results = json.loads(output.decode())['results']
+        self.assertEqual(3000, results[0]['size'])
+        self.assertGreater(results[0]['full'], 0)
+
+
 if __name__ == '__main__':
     make_dirs()
     unittest.main()